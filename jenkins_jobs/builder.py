@@ -20,16 +20,101 @@ import hashlib
 import yaml
 import xml.etree.ElementTree as XML
 from xml.dom import minidom
-import jenkins
 import re
 import pkg_resources
 import logging
 import copy
 import itertools
-from jenkins_jobs.errors import JenkinsJobsException
+import json
+import cPickle
+import tempfile
+import heapq
+import zlib
+import time
+import atexit
+import random
+import math
+import threading
+import sqlite3
+import base64
+import urllib2
+import fnmatch
+import difflib
+import sys
+from jenkins_jobs.errors import JenkinsJobsException, NoScriptConsoleError
+from jenkins_jobs.files import give_to_owner, write_file_atomically
+from jenkins_jobs.parallel import run_in_parallel, Scheduler
+from jenkins_jobs.plan import Change, Journal, PHASES, PlanWriter, read_plan
+from jenkins_jobs.transport import HTTPError, PooledJenkins, is_transient
+from jenkins_jobs.version import version_info
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_FORMATS = ('pretty', 'compact')
+
+
+def get_config_option(config, section, option, default=None):
+    """Return the value of an option from the configuration file, or
+       default if it is not set (or if there is no configuration file, as
+       when generating test output)."""
+    if not config or not config.has_option(section, option):
+        return default
+    return config.get(section, option)
+
+
+def get_masters(config):
+    """Return the Jenkins masters of the configuration file, as a list of
+    (name, section) pairs: the master of the ``jenkins`` section, named
+    ``default``, if it has a url, then that of each ``jenkins:NAME``
+    section."""
+    if not config:
+        return [('default', 'jenkins')]
+    masters = []
+    if config.has_option('jenkins', 'url'):
+        masters.append(('default', 'jenkins'))
+    for section in config.sections():
+        if section.startswith('jenkins:'):
+            if not config.has_option(section, 'url'):
+                raise JenkinsJobsException("No url for Jenkins master "
+                                           "{0}".format(section[8:]))
+            masters.append((section[8:], section))
+    return masters
+
+
+def get_master_option(config, section, option, default=None):
+    """Like get_config_option(), for an option of the Jenkins master
+    configured in section, which falls back to the ``jenkins``
+    section."""
+    return get_config_option(config, section, option, get_config_option(
+        config, 'jenkins', option, default))
+
+
+def get_config_bool(config, section, option, default=False):
+    """Like get_config_option(), for options holding a boolean."""
+    if not config or not config.has_option(section, option):
+        return default
+    return config.getboolean(section, option)
+
+
+def fingerprint(*objs):
+    """Return a stable hash of the supplied YAML-derived data structures.
+       Dict keys are sorted, so two equal structures always have the same
+       fingerprint regardless of how they were built."""
+    return hashlib.md5(json.dumps(objs, sort_keys=True,
+                                  default=repr)).hexdigest()
+
+
+def generator_fingerprint(config):
+    """Return a fingerprint of what, besides the YAML definitions, affects
+       the XML generated for jobs: the version of jenkins-job-builder and
+       the configuration file (some modules take settings from it)."""
+    config_items = []
+    if config:
+        for section in sorted(config.sections()):
+            config_items.append((section,
+                                 sorted(config.items(section, raw=True))))
+    return fingerprint(version_info.version_string(), config_items)
+
 
 def deep_format(obj, paramdict):
     """Apply the paramdict via str.format() to all string objects found within
@@ -54,10 +139,28 @@ def deep_format(obj, paramdict):
 
 
 class YamlParser(object):
-    def __init__(self, config=None):
+    # Top-level definitions which are not macros
+    definition_types = ('job', 'job-template', 'job-group', 'project',
+                        'defaults')
+
+    def __init__(self, config=None, cache=None):
         self.registry = ModuleRegistry(config)
         self.data = {}
-        self.jobs = []
+        budget = get_config_option(config, 'job_builder', 'memory-budget')
+        if budget is not None:
+            budget = int(budget) * 1024 * 1024
+        self.jobs = JobList(budget)
+        self.sections = None
+        self.section_cache = None
+        if get_config_bool(config, 'job_builder', 'section-cache'):
+            self.section_cache = SectionCache(config)
+        # When a cache is given, jobs whose definition has the same
+        # fingerprint as when they were last updated are not generated,
+        # only their names are kept in unchanged.
+        self.cache = cache
+        self.unchanged = set()
+        if cache is not None:
+            self.salt = generator_fingerprint(config)
 
     def parse(self, fn):
         data = yaml.load(open(fn))
@@ -100,7 +203,9 @@ class YamlParser(object):
         newdata.update(data)
         return newdata
 
-    def generateXML(self):
+    def generateXML(self, complete=False):
+        # complete tells that every definition was parsed, so that the
+        # cached sections of the jobs not generated can be dropped.
         changed = True
         while changed:
             changed = False
@@ -151,6 +256,9 @@ class YamlParser(object):
                     d.update(jobparams)
                     self.getXMLForTemplateJob(d, template)
 
+        if self.section_cache:
+            self.section_cache.save(prune=complete)
+
     def getXMLForTemplateJob(self, project, template):
         dimensions = []
         for (k, v) in project.items():
@@ -166,26 +274,339 @@ class YamlParser(object):
             logger.debug("Generating XML for template job {0}"
                          " (params {1})".format(
                              template['name'], params))
-            self.getXMLForJob(deep_format(template, params))
+            # The name of the template, and the list of jobs naming it,
+            # may change
+            source = fingerprint(
+                dict((k, v) for k, v in template.items() if k != 'name'),
+                dict((k, v) for k, v in params.items() if k != 'jobs'))
+            self.getXMLForJob(deep_format(template, params), source)
 
-    def getXMLForJob(self, data):
+    def getMacros(self, data, macros=None):
+        """Return the definitions of the macros data refers to, directly
+        or through other macros, as a dict of (type, name): definition."""
+        if macros is None:
+            macros = {}
+        if isinstance(data, dict):
+            for value in data.values():
+                self.getMacros(value, macros)
+        elif isinstance(data, list):
+            for item in data:
+                # Components are either names, or singleton dicts of the
+                # name and its arguments
+                if isinstance(item, dict) and len(item) == 1:
+                    name = item.keys()[0]
+                else:
+                    name = item
+                if isinstance(name, basestring):
+                    for kind, group in self.data.items():
+                        if kind in self.definition_types:
+                            continue
+                        key = (kind, name)
+                        if name in group and key not in macros:
+                            macros[key] = group[name]
+                            self.getMacros(group[name], macros)
+                self.getMacros(item, macros)
+        return macros
+
+    def getJobFingerprint(self, data):
+        """Return a fingerprint of everything the XML of a job is generated
+        from: its expanded definition and the macros it uses."""
+        return fingerprint(self.salt, data,
+                           sorted(self.getMacros(data).items()))
+
+    def getXMLForJob(self, data, source=None):
         kind = data.get('project-type', 'freestyle')
+        job_fingerprint = None
+        if self.cache is not None:
+            # This must be done before generating the XML, some components
+            # normalize the data they are given in place.
+            job_fingerprint = self.getJobFingerprint(data)
+            if self.cache.get_fingerprint(data['name']) == job_fingerprint:
+                logger.debug("'{0}' has not changed since it was last "
+                             "updated".format(data['name']))
+                self.unchanged.add(data['name'])
+                self.jobs.skip(data['name'])
+                if self.section_cache:
+                    self.section_cache.keep(data['name'])
+                return
         for ep in pkg_resources.iter_entry_points(
             group='jenkins_jobs.projects', name=kind):
             Mod = ep.load()
             mod = Mod(self.registry)
             xml = mod.root_xml(data)
+            self.sections = JobSections(xml)
             self.gen_xml(xml, data)
-            job = XmlJob(xml, data['name'])
+            self.sections = None
+            job = XmlJob(xml, data['name'], job_fingerprint, source)
+            # The latest definition of a job wins, even over one which
+            # was skipped
+            self.unchanged.discard(job.name)
             self.jobs.append(job)
             break
 
+    def getSection(self, xml_parent, tag):
+        """Return the top-level section named tag of the job being
+        generated, creating it in its canonical position if needed."""
+        if self.sections is None or self.sections.root is not xml_parent:
+            section = xml_parent.find(tag)
+            if section is None:
+                section = XML.SubElement(xml_parent, tag)
+            return section
+        return self.sections.get(tag)
+
     def gen_xml(self, xml, data):
+        if self.section_cache:
+            self.section_cache.gen_xml(self, xml, data)
+            return
         for module in self.registry.modules:
             if hasattr(module, 'gen_xml'):
                 module.gen_xml(self, xml, data)
 
 
+class JobSections(object):
+    """Index of the top-level sections of a job being generated.
+
+    Several modules contribute to the same section (parameters and
+    notifications are both job properties, for example), so rather than
+    each of them searching the job's children for it, sections are
+    looked up by tag here.  A section which does not exist yet is created
+    in its position in :attr:`ORDER`, so the layout of a job does not
+    depend on which module happened to ask for a section first.
+    Elements appended to the root directly are indexed as they are
+    found, so modules which do not use the index still work.
+    """
+
+    #: The canonical order of the top-level sections of a job.  Sections
+    #: which are not listed here are appended in the order they are made.
+    ORDER = ('properties', 'scm', 'triggers', 'reporters', 'prebuilders',
+             'builders', 'postbuilders', 'publishers', 'buildWrappers')
+    RANKS = dict((tag, rank) for rank, tag in enumerate(ORDER))
+
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        self.scanned = 0
+
+    def _scan(self):
+        for child in self.root[self.scanned:]:
+            self.index.setdefault(child.tag, child)
+        self.scanned = len(self.root)
+
+    def get(self, tag):
+        """Return the section named tag, creating it if needed."""
+        section = self.index.get(tag)
+        if section is None:
+            self._scan()
+            section = self.index.get(tag)
+            if section is None:
+                section = XML.Element(tag)
+                self.insert(section)
+        return section
+
+    def insert(self, elem):
+        """Add a new top-level element in its canonical position."""
+        self._scan()
+        rank = self.RANKS.get(elem.tag)
+        position = None
+        if rank is not None:
+            later = [self.index[tag] for tag in self.ORDER[rank + 1:]
+                     if tag in self.index]
+            if later:
+                children = list(self.root)
+                position = min(children.index(section) for section in later)
+        if position is None:
+            self.root.append(elem)
+        else:
+            self.root.insert(position, elem)
+        self.index.setdefault(elem.tag, elem)
+        self.scanned = len(self.root)
+
+
+class RecordingDict(dict):
+    """A dict which remembers which of its keys have been looked up, so
+       that the subset of the data something depended on can be known
+       after the fact.  Iterating over the whole dict records every key."""
+
+    def __init__(self, data):
+        dict.__init__(self, data)
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.accessed.add(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.accessed.add(key)
+        return dict.get(self, key, default)
+
+    def has_key(self, key):
+        return key in self
+
+    def _all(self):
+        self.accessed.update(dict.keys(self))
+
+    def __iter__(self):
+        self._all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._all()
+        return dict.keys(self)
+
+    def values(self):
+        self._all()
+        return dict.values(self)
+
+    def items(self):
+        self._all()
+        return dict.items(self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        self._all()
+        return dict(self)
+
+
+class SectionCache(object):
+    """Persistent cache of the XML each module generates for each job.
+
+    Every module's contribution to a job is stored together with the
+    names of the job data keys and macro groups it read, and a
+    fingerprint of their values.  On the next run a module is only
+    called again if the fingerprint of those same keys has changed;
+    otherwise its XML is spliced back into the job from the cache.
+
+    Modules only ever append elements, either to the job's root element
+    or to one of its existing top-level sections (such as
+    ``properties``), so a module's contribution is recorded as the list
+    of elements it appended and the tag of the section they went into.
+    Cached elements are put back through the job's :class:`JobSections`.
+
+    After a run over every definition, the sections of the jobs which
+    were neither generated nor skipped as unchanged are dropped, so that
+    deleted and renamed jobs do not stay in the cache forever.
+    """
+
+    def __init__(self, config=None):
+        self.filename = os.path.join(CacheStorage.get_cache_dir(),
+                                     'jenkins_jobs_sections.pickle')
+        try:
+            with open(self.filename, 'rb') as cachefile:
+                self.data = cPickle.load(cachefile)
+            logger.debug("Using section cache: '{0}'".format(self.filename))
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            self.data = {}
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.group_fingerprints = {}
+        self.salt = generator_fingerprint(config)
+
+    def _group_fingerprint(self, parser, group):
+        if group not in self.group_fingerprints:
+            self.group_fingerprints[group] = fingerprint(
+                parser.data.get(group))
+        return self.group_fingerprints[group]
+
+    def _fingerprint(self, module, parser, xml, key_fingerprints, keys,
+                     groups):
+        return fingerprint(self.salt, module.__class__.__name__, xml.tag,
+                           [(key, key_fingerprints.get(key)) for key in keys],
+                           [self._group_fingerprint(parser, group)
+                            for group in groups])
+
+    def _splice(self, parser, fragments):
+        for tag, text in fragments:
+            if tag is None:
+                parser.sections.insert(XML.fromstring(text))
+            else:
+                parser.sections.get(tag).append(XML.fromstring(text))
+
+    def gen_xml(self, parser, xml, data):
+        # Some components normalize the data they are given in place, so
+        # the inputs are fingerprinted before any module has run.
+        key_fingerprints = dict((key, fingerprint(value))
+                                for key, value in data.items())
+        self.keep(data['name'])
+        job_sections = self.data.setdefault(data['name'], {})
+        for module in parser.registry.modules:
+            if hasattr(module, 'gen_xml'):
+                self._gen_module_xml(module, parser, xml, data,
+                                     key_fingerprints, job_sections)
+
+    def _gen_module_xml(self, module, parser, xml, data, key_fingerprints,
+                        job_sections):
+        name = module.__class__.__name__
+        cached = job_sections.get(name)
+        if cached:
+            keys, groups, old_fingerprint, fragments = cached
+            if self._fingerprint(module, parser, xml, key_fingerprints,
+                                 keys, groups) == old_fingerprint:
+                self._splice(parser, fragments)
+                self.hits += 1
+                return
+        self.misses += 1
+
+        # Remember what the job looked like before the module ran
+        child_sizes = dict((id(child), len(child)) for child in xml)
+
+        recording_data = RecordingDict(data)
+        parser_data = parser.data
+        parser.data = RecordingDict(parser_data)
+        try:
+            module.gen_xml(parser, xml, recording_data)
+        finally:
+            groups = sorted(parser.data.accessed)
+            parser.data = parser_data
+
+        fragments = []
+        for child in xml:
+            size = child_sizes.get(id(child))
+            if size is None:
+                fragments.append((None, XML.tostring(child)))
+            else:
+                for elem in child[size:]:
+                    fragments.append((child.tag, XML.tostring(elem)))
+        keys = sorted(recording_data.accessed)
+        job_sections[name] = (
+            keys, groups,
+            self._fingerprint(module, parser, xml, key_fingerprints, keys,
+                              groups),
+            fragments)
+
+    def keep(self, job):
+        """Record that job is still defined, so that its sections are not
+        dropped."""
+        self.used.add(job)
+
+    def save(self, prune=False):
+        """Save the cache, keeping only the sections of the jobs used on
+        this run if prune is true."""
+        logger.debug("Section cache: {0} sections reused, "
+                     "{1} generated".format(self.hits, self.misses))
+        if prune:
+            unused = set(self.data) - self.used
+            for job in unused:
+                del self.data[job]
+            logger.debug("Section cache: dropped {0} jobs no longer "
+                         "defined".format(len(unused)))
+        write_file_atomically(
+            self.filename,
+            lambda f: cPickle.dump(self.data, f, cPickle.HIGHEST_PROTOCOL))
+
+
 class ModuleRegistry(object):
     def __init__(self, config):
         self.modules = []
@@ -209,36 +630,303 @@ class ModuleRegistry(object):
         return self.handlers[category][name]
 
 
+# Jenkins prefixes config.xml with its own declaration (sometimes claiming
+# XML 1.1, which expat refuses), so it is stripped before parsing.
+xml_declaration_re = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+def canonical_xml(xml):
+    """Return a canonical serialization of an XML document or element.
+
+    Whitespace-only text and tails are dropped, the XML declaration is
+    removed, attributes are written in sorted order and the ``plugin``
+    attributes Jenkins adds when it saves a job are ignored.  Two
+    documents with the same canonical form configure the same job, so
+    hashing this form rather than the raw text avoids reconfiguring jobs
+    whose only difference is how they were formatted.
+
+    :arg xml: an Element, or the text of an XML document
+    :rtype: str
+    """
+    if isinstance(xml, basestring):
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        root = XML.fromstring(xml_declaration_re.sub('', xml, 1))
+    else:
+        # Work on a copy, the caller's tree must not be modified
+        root = XML.fromstring(XML.tostring(xml))
+    for elem in root.iter():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        if elem.tail is not None and not elem.tail.strip():
+            elem.tail = None
+        elem.attrib.pop('plugin', None)
+    # ElementTree serializes attributes in sorted order and, for utf-8,
+    # without a declaration.
+    return XML.tostring(root, encoding='utf-8')
+
+
+def xml_tokens(xml):
+    """Split the canonical form of an XML document into its elements, to
+    measure how similar two documents are."""
+    return canonical_xml(xml).split('><')
+
+
+def canonical_lines(xml):
+    """Return the canonical form of an XML document indented with one
+    element per line, as a list of lines to be compared with difflib."""
+    pretty = minidom.parseString(canonical_xml(xml)).toprettyxml(
+        indent='  ', encoding='utf-8')
+    return XmlJob.pretty_text_re.sub('>\g<1></', pretty).splitlines()
+
+
+def name_matcher(patterns, regex=False):
+    """Return a function telling whether a job name matches any of
+    patterns, shell-style wildcards or, if regex is true, regular
+    expressions which must match the whole name."""
+    if regex:
+        expressions = [re.compile('(?:{0})$'.format(pattern))
+                       for pattern in patterns]
+
+        def matches(name):
+            return any(expression.match(name) for expression in expressions)
+    else:
+        def matches(name):
+            return any(fnmatch.fnmatchcase(name, pattern)
+                       for pattern in patterns)
+    return matches
+
+
+def unique_pairs(old, new, old_key, new_key):
+    """Return the (old name, new job) pairs of the jobs which are the only
+    ones on each side to share a key, other than None."""
+    old_names = {}
+    for name in old:
+        old_names.setdefault(old_key(name), []).append(name)
+    new_jobs = {}
+    for job in new:
+        new_jobs.setdefault(new_key(job), []).append(job)
+    return [(names[0], new_jobs[key][0])
+            for key, names in old_names.iteritems()
+            if key is not None and len(names) == 1 and
+            len(new_jobs.get(key, ())) == 1]
+
+
 class XmlJob(object):
-    def __init__(self, xml, name):
-        self.xml = xml
+    """A generated job.  Large runs hold tens of thousands of these, so
+    rather than the element tree only the compressed serialized XML is
+    kept; the tree is rebuilt when the xml attribute is used."""
+
+    __slots__ = ('name', 'fingerprint', 'source', '_data', '_md5')
+
+    def __init__(self, xml, name, fingerprint=None, source=None):
+        if isinstance(name, str):
+            name = intern(name)
         self.name = name
+        # The fingerprint of the definition the job was generated from
+        self.fingerprint = fingerprint
+        # The fingerprint of the project and parameters a template job
+        # was generated from, which do not change with its name
+        self.source = source
+        self._data = zlib.compress(XML.tostring(xml))
+        self._md5 = None
+
+    def __getstate__(self):
+        return (self.name, self.fingerprint, self.source, self._data,
+                self._md5)
+
+    def __setstate__(self, state):
+        (self.name, self.fingerprint, self.source, self._data,
+         self._md5) = state
+
+    @property
+    def xml(self):
+        return XML.fromstring(self.tostring())
+
+    def tostring(self):
+        """Return the XML of the job as it was generated, unindented and
+        without a declaration."""
+        return zlib.decompress(self._data)
+
+    def size(self):
+        """Approximate memory used by the job, in bytes."""
+        return len(self._data) + len(self.name) + 128
 
     def md5(self):
-        return hashlib.md5(self.output()).hexdigest()
+        if self._md5 is None:
+            self._md5 = hashlib.md5(canonical_xml(self.tostring())).hexdigest()
+        return self._md5
 
     # Pretty printing ideas from
     # http://stackoverflow.com/questions/749796/pretty-printing-xml-in-python
     pretty_text_re = re.compile('>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
 
     def output(self):
-        out = minidom.parseString(XML.tostring(self.xml))
+        out = minidom.parseString(self.tostring())
         out = out.toprettyxml(indent='  ')
         return self.pretty_text_re.sub('>\g<1></', out)
 
+    def compact_output(self):
+        """Serialize the job without indentation, straight from the tree.
+        This is what Jenkins receives when ``upload-format`` is
+        ``compact``; it is cheaper to produce and smaller on the wire."""
+        return "<?xml version='1.0' encoding='UTF-8'?>\n" + self.tostring()
+
+
+class JobList(object):
+    """The jobs generated by a parser, iterated in order of name.
+
+    If a memory budget (in bytes) is given, whenever the jobs held in
+    memory exceed it they are sorted and spilled to a temporary file.
+    Iterating merges the spilled runs with the jobs still in memory, so
+    only one job per run needs to be in memory at a time.
+
+    The definitions of jobs which were not generated because they had
+    not changed are recorded with :meth:`skip`, so that an earlier
+    definition of the same job is not taken for the latest one.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.jobs = []
+        self.size = 0
+        self.runs = []
+        self.count = 0
+        self.sequence = 0
+        # The sequence number of the last skipped definition of a job
+        self.skipped = {}
+
+    def __len__(self):
+        return self.count
+
+    def append(self, job):
+        # The sequence number keeps jobs sharing a name in the order
+        # they were defined, and means the jobs are never compared.
+        self.jobs.append((job.name, self.sequence, job))
+        self.sequence += 1
+        self.count += 1
+        self.size += job.size()
+        if self.budget is not None and self.size > self.budget:
+            self._spill()
+
+    def skip(self, name):
+        """Record that a definition of job name was not generated."""
+        self.skipped[name] = self.sequence
+        self.sequence += 1
+
+    def _spill(self):
+        self.jobs.sort()
+        run = tempfile.TemporaryFile(prefix='jenkins_jobs')
+        pickler = cPickle.Pickler(run, cPickle.HIGHEST_PROTOCOL)
+        for entry in self.jobs:
+            pickler.dump(entry)
+            # Every job is written once, don't let the pickler hold on
+            # to them.
+            pickler.clear_memo()
+        logger.debug("Spilled {0} jobs ({1} bytes) to disk".format(
+            len(self.jobs), self.size))
+        self.runs.append(run)
+        self.jobs = []
+        self.size = 0
+
+    @staticmethod
+    def _read_run(run):
+        run.seek(0)
+        unpickler = cPickle.Unpickler(run)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+    def _entries(self):
+        self.jobs.sort()
+        runs = [self._read_run(run) for run in self.runs]
+        return heapq.merge(self.jobs, *runs)
+
+    def __iter__(self):
+        for name, sequence, job in self._entries():
+            yield job
+
+    def latest(self):
+        """Iterate over the jobs like iter(), but only over the latest
+        definition of jobs which were defined more than once, and not
+        over jobs whose latest definition was skipped."""
+        for name, entries in itertools.groupby(self._entries(),
+                                               lambda entry: entry[0]):
+            for name, sequence, job in entries:
+                pass
+            if self.skipped.get(name, -1) < sequence:
+                yield job
+
+
+# The C implementations are much faster on caches with many entries
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+YamlDumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
 
 class CacheStorage(object):
-    def __init__(self):
+    """The hashes of the jobs last seen on or sent to Jenkins.
+
+    Along with its hash, the fingerprint of the YAML definition a job
+    was generated from is kept for jobs which were uploaded (or found
+    up to date) by jenkins-jobs, so that unchanged jobs need not be
+    generated at all on the next run.  Fingerprints are kept in a
+    separate file so that the job cache keeps its format.
+
+    Jobs uploaded or found up to date by jenkins-jobs are also marked as
+    managed, unlike jobs which are only cached because they were found
+    on Jenkins, so that jobs created by other means are never taken for
+    jobs whose definition was removed.  Managed jobs are listed in a
+    third file.  A fourth one keeps the source of template jobs, a
+    fingerprint of the template, project and parameters they were
+    generated from, which tells which new job an old one was renamed to.
+    Hashes and fingerprints are shared by every Jenkins master, but
+    managed jobs and sources are kept for each master (the namespace is
+    the master's URL), so that no master's jobs are taken for another's.
+
+    Changes are kept in memory and written out by :meth:`save`, which
+    replaces the cache files atomically so that an interrupted run never
+    leaves a truncated cache behind.  Pending changes are also saved
+    every :attr:`save_interval` seconds while jobs are being updated and
+    when the process exits.  The cache may be used from several threads.
+    """
+
+    #: Maximum number of seconds changes are kept only in memory
+    save_interval = 30
+
+    def __init__(self, namespace=None):
+        self.namespace = (namespace or '').rstrip('/')
         cache_dir = self.get_cache_dir()
         self.cachefilename = os.path.join(cache_dir, 'jenkins_jobs_cache.yml')
+        self.fingerprintfilename = os.path.join(
+            cache_dir, 'jenkins_jobs_fingerprints.yml')
+        self.managedfilename = os.path.join(cache_dir,
+                                            'jenkins_jobs_managed.yml')
+        self.sourcefilename = os.path.join(cache_dir,
+                                           'jenkins_jobs_sources.yml')
+        self.dirty = False
+        self.last_save = time.time()
+        self.lock = threading.RLock()
+        atexit.register(self.save)
+        self.data = self._load(self.cachefilename)
+        self.fingerprints = self._load(self.fingerprintfilename)
+        self.all_managed = self._load(self.managedfilename)
+        self.all_sources = self._load(self.sourcefilename)
+        self.managed = set(self.all_managed.get(self.namespace, ()))
+        self.sources = self.all_sources.setdefault(self.namespace, {})
+
+    @staticmethod
+    def _load(filename):
         try:
-            yfile = file(self.cachefilename, 'r')
+            yfile = file(filename, 'r')
         except IOError:
-            self.data = {}
-            return
-        self.data = yaml.load(yfile)
-        logger.debug("Using cache: '{0}'".format(self.cachefilename))
-        yfile.close()
+            return {}
+        logger.debug("Using cache: '{0}'".format(filename))
+        try:
+            return yaml.load(yfile, Loader=YamlLoader) or {}
+        finally:
+            yfile.close()
 
     @staticmethod
     def get_cache_dir():
@@ -252,11 +940,54 @@ class CacheStorage(object):
             os.makedirs(path)
         return path
 
-    def set(self, job, md5):
-        self.data[job] = md5
-        yfile = file(self.cachefilename, 'w')
-        yaml.dump(self.data, yfile)
-        yfile.close()
+    def set(self, job, md5, fingerprint=None, managed=None, source=None):
+        """Record the hash of a job, and the fingerprint of the definition
+        it was generated from if it was generated by jenkins-jobs.  Unless
+        they are None, also record whether the job is managed by
+        jenkins-jobs, and its source."""
+        with self.lock:
+            self.data[job] = md5
+            if fingerprint is None:
+                self.fingerprints.pop(job, None)
+            else:
+                self.fingerprints[job] = fingerprint
+            if managed:
+                self.managed.add(job)
+            elif managed is not None:
+                self.managed.discard(job)
+            if source is not None:
+                self.sources[job] = source
+            self._changed()
+
+    def mark_managed(self, job):
+        """Record that the cached job is managed by jenkins-jobs."""
+        self.set(job, self.get(job), self.get_fingerprint(job), True)
+
+    def _changed(self):
+        self.dirty = True
+        if time.time() - self.last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        """Write pending changes to the cache file."""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.all_managed[self.namespace] = sorted(self.managed)
+            for filename, data in ((self.cachefilename, self.data),
+                                   (self.fingerprintfilename,
+                                    self.fingerprints),
+                                   (self.managedfilename, self.all_managed),
+                                   (self.sourcefilename, self.all_sources)):
+                write_file_atomically(
+                    filename,
+                    lambda yfile: yaml.dump(data, yfile, Dumper=YamlDumper))
+            self.dirty = False
+            self.last_save = time.time()
+
+    def get(self, job):
+        """Return the cached hash of job, or None if it is not cached."""
+        return self.data.get(job)
 
     def is_cached(self, job):
         if job in self.data:
@@ -268,10 +999,260 @@ class CacheStorage(object):
             return False
         return True
 
+    def get_fingerprint(self, job):
+        """Return the fingerprint of the definition the job on Jenkins
+        was generated from, or None if it is not known."""
+        return self.fingerprints.get(job)
+
+    def jobs(self):
+        """Return the names of the cached jobs which exist on Jenkins."""
+        with self.lock:
+            return [job for job, md5 in self.data.iteritems() if md5]
+
+    def get_source(self, job):
+        """Return the source of the job, or None if it is not known."""
+        return self.sources.get(job)
+
+    def is_managed(self, job):
+        return job in self.managed
+
+    def managed_jobs(self):
+        """Return the names of the managed jobs which exist on Jenkins."""
+        with self.lock:
+            return [job for job in self.managed if self.data.get(job)]
+
+
+class SqliteCacheStorage(CacheStorage):
+    """A job cache kept in an SQLite database.
+
+    Unlike the YAML cache, entries are kept apart for each Jenkins master
+    (the namespace is the master's URL), the database is not loaded into
+    memory, and it may be used by several ``jenkins-jobs`` processes, or
+    several threads, at the same time.  Changes are buffered as for the
+    YAML cache and written by :meth:`save` in a single transaction.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+                    namespace TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    md5 TEXT NOT NULL,
+                    PRIMARY KEY (namespace, name))"""
+
+    #: Columns added since the table was first created, and their types
+    COLUMNS = (('fingerprint', 'TEXT'), ('managed', 'INTEGER'),
+               ('source', 'TEXT'))
+
+    #: Seconds to wait for another process to finish writing
+    timeout = 60
+
+    def __init__(self, namespace):
+        self.namespace = namespace.rstrip('/')
+        self.filename = os.path.join(self.get_cache_dir(),
+                                     'jenkins_jobs_cache.sqlite')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.dirty = False
+        self.last_save = time.time()
+        with self._connection() as connection:
+            connection.execute(self.SCHEMA)
+            existing = set(row[1] for row in
+                           connection.execute('PRAGMA table_info(jobs)'))
+            for column, column_type in self.COLUMNS:
+                if column not in existing:
+                    connection.execute('ALTER TABLE jobs ADD COLUMN '
+                                       '{0} {1}'.format(column, column_type))
+        logger.debug("Using cache: '{0}' for '{1}'".format(self.filename,
+                                                           self.namespace))
+        atexit.register(self.save)
+
+    def _connection(self):
+        # SQLite connections may not be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=self.timeout)
+            connection.text_factory = str
+            # Readers do not block the writer, nor the writer readers
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def _get(self, job):
+        with self.lock:
+            if job in self.pending:
+                return self.pending[job]
+        return self._connection().execute(
+            'SELECT md5, fingerprint FROM jobs '
+            'WHERE namespace = ? AND name = ?',
+            (self.namespace, job)).fetchone()
+
+    def get(self, job):
+        """Return the cached hash of job, or None if it is not cached."""
+        row = self._get(job)
+        if row is None:
+            return None
+        return row[0]
+
+    def get_fingerprint(self, job):
+        row = self._get(job)
+        if row is None:
+            return None
+        return row[1]
+
+    def set(self, job, md5, fingerprint=None, managed=None, source=None):
+        with self.lock:
+            if job in self.pending:
+                if managed is None:
+                    managed = self.pending[job][2]
+                if source is None:
+                    source = self.pending[job][3]
+            self.pending[job] = (md5, fingerprint, managed, source)
+        self._changed()
+
+    def get_source(self, job):
+        with self.lock:
+            if job in self.pending and self.pending[job][3] is not None:
+                return self.pending[job][3]
+        row = self._connection().execute(
+            'SELECT source FROM jobs WHERE namespace = ? AND name = ?',
+            (self.namespace, job)).fetchone()
+        return row and row[0]
+
+    def is_cached(self, job):
+        return self.get(job) is not None
+
+    def has_changed(self, job, md5):
+        return self.get(job) != md5
+
+    def jobs(self):
+        rows = self._connection().execute(
+            'SELECT name, md5 FROM jobs WHERE namespace = ?',
+            (self.namespace,))
+        jobs = dict(rows)
+        with self.lock:
+            jobs.update((job, entry[0])
+                        for job, entry in self.pending.iteritems())
+        return [job for job, md5 in jobs.iteritems() if md5]
+
+    def is_managed(self, job):
+        with self.lock:
+            if job in self.pending and self.pending[job][2] is not None:
+                return bool(self.pending[job][2])
+        row = self._connection().execute(
+            'SELECT managed FROM jobs WHERE namespace = ? AND name = ?',
+            (self.namespace, job)).fetchone()
+        return bool(row and row[0])
+
+    def managed_jobs(self):
+        rows = self._connection().execute(
+            'SELECT name, md5, managed FROM jobs WHERE namespace = ?',
+            (self.namespace,))
+        jobs = dict((job, (md5, managed)) for job, md5, managed in rows)
+        with self.lock:
+            for job, (md5, fingerprint, managed, source) in \
+                    self.pending.iteritems():
+                if managed is None:
+                    managed = jobs.get(job, (None, None))[1]
+                jobs[job] = (md5, managed)
+        return [job for job, entry in jobs.iteritems() if all(entry)]
+
+    def save(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.dirty = False
+            self.last_save = time.time()
+        if not pending:
+            return
+        try:
+            with self._connection() as connection:
+                # Entries whose managed status or source is not given
+                # keep the one they have
+                connection.executemany(
+                    'INSERT OR REPLACE INTO jobs '
+                    '(namespace, name, md5, fingerprint, managed, source) '
+                    'VALUES (?, ?, ?, ?, '
+                    'COALESCE(?, (SELECT managed FROM jobs '
+                    'WHERE namespace = ? AND name = ?), 0), '
+                    'COALESCE(?, (SELECT source FROM jobs '
+                    'WHERE namespace = ? AND name = ?)))',
+                    [(self.namespace, job, md5, fingerprint,
+                      managed, self.namespace, job,
+                      source, self.namespace, job)
+                     for job, (md5, fingerprint, managed, source)
+                     in pending.iteritems()])
+        except sqlite3.Error:
+            # Keep the changes for the next attempt, unless they have
+            # been superseded in the meantime
+            with self.lock:
+                pending.update(self.pending)
+                self.pending = pending
+                self.dirty = True
+            raise
+
+    def migrate(self, cache):
+        """Copy every entry of another cache, such as the YAML cache,
+        into this cache's namespace."""
+        for job, md5 in cache.data.iteritems():
+            self.set(job, md5, cache.get_fingerprint(job),
+                     cache.is_managed(job), cache.get_source(job))
+        self.save()
+        return len(cache.data)
+
+
+CACHE_BACKENDS = {
+    'yaml': CacheStorage,
+    'sqlite': SqliteCacheStorage,
+}
+
+
+# Creates or updates jobs from the script console.  Names and
+# configurations are base64 encoded, so that they need no quoting, and
+# the outcome for each job is printed on a line of its own.
+SCRIPT_RESULT = 'JJB-RESULT'
+SCRIPT_JOB = "  ['{0}', '{1}'],"
+UPDATE_JOBS_SCRIPT = """import jenkins.model.Jenkins
+import javax.xml.transform.stream.StreamSource
+
+def jobs = [
+{jobs}
+]
+def decode = {{ new String(it.decodeBase64(), 'UTF-8') }}
+jobs.each {{ item ->
+  try {{
+    def name = decode(item[0])
+    def xml = new ByteArrayInputStream(item[1].decodeBase64())
+    def job = Jenkins.instance.getItem(name)
+    if (job == null) {{
+      Jenkins.instance.createProjectFromXML(name, xml)
+      println '{result} created ' + item[0]
+    }} else {{
+      job.updateByXml(new StreamSource(xml))
+      job.save()
+      println '{result} updated ' + item[0]
+    }}
+  }} catch (e) {{
+    println '{result} failed ' + item[0] + ' ' +
+        e.toString().getBytes('UTF-8').encodeBase64()
+  }}
+}}
+"""
+
 
 class Jenkins(object):
-    def __init__(self, url, user, password):
-        self.jenkins = jenkins.Jenkins(url, user, password)
+    """The jobs on a Jenkins server.
+
+    The names of all jobs are fetched once, the first time they are
+    needed, and kept up to date as jobs are created and deleted, so
+    checking whether a job exists costs no request.  Jobs created or
+    deleted on the server by others in the meantime are not noticed
+    until :meth:`get_job_names` is called again.
+    """
+
+    def __init__(self, url, user, password, pool_size=8, timeout=None):
+        self.jenkins = PooledJenkins(url, user, password, pool_size, timeout)
+        self.job_names = None
+        self.job_names_lock = threading.Lock()
 
     def update_job(self, job_name, xml):
         if self.is_job(job_name):
@@ -280,58 +1261,478 @@ class Jenkins(object):
         else:
             logger.info("Creating jenkins job {0}".format(job_name))
             self.jenkins.create_job(job_name, xml)
+            self._job_names().add(job_name)
+
+    def update_jobs_by_script(self, jobs):
+        """Create or reconfigure several jobs with a single script console
+        request.  jobs is a list of (name, xml) pairs.  Returns a dict
+        of the names of the jobs which were created or updated to None,
+        and of those which failed to the error Jenkins gave.  Jobs the
+        script did not get to are left out."""
+        def encode(text):
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            return base64.b64encode(text)
+        names = dict((encode(name), name) for name, xml in jobs)
+        script = UPDATE_JOBS_SCRIPT.format(
+            jobs='\n'.join(SCRIPT_JOB.format(encode(name), encode(xml))
+                           for name, xml in jobs),
+            result=SCRIPT_RESULT)
+        output = self.jenkins.run_script(script)
+        if output is None:
+            raise NoScriptConsoleError("Jenkins has no script console")
+        results = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if (len(fields) < 3 or fields[0] != SCRIPT_RESULT or
+                    fields[2] not in names):
+                continue
+            name = names[fields[2]]
+            if fields[1] == 'failed':
+                results[name] = base64.b64decode(fields[3]).decode('utf-8')
+                continue
+            logger.info("{0} jenkins job {1}".format(
+                fields[1] == 'created' and 'Created' or 'Reconfigured',
+                name))
+            self._job_names().add(name)
+            results[name] = None
+        return results
+
+    def _job_names(self):
+        with self.job_names_lock:
+            if self.job_names is None:
+                self.job_names = set(self._get_job_names())
+            return self.job_names
 
     def is_job(self, job_name):
-        return self.jenkins.job_exists(job_name)
+        return job_name in self._job_names()
 
-    def get_job_md5(self, job_name):
+    def list_jobs(self, scheduler):
+        """Fetch the names of the jobs, unless they already were, through
+        scheduler so that transient errors are retried."""
+        scheduler.call(self._job_names)
+
+    def get_job_config(self, job_name):
         xml = self.jenkins.get_job_config(job_name)
+        if xml is None:
+            raise JenkinsJobsException("Could not fetch the configuration "
+                                       "of jenkins job {0}".format(job_name))
+        return xml
+
+    def get_job_md5(self, job_name):
+        xml = self.get_job_config(job_name)
+        try:
+            xml = canonical_xml(xml)
+        except SyntaxError:
+            # Not something we could have generated, so hashing the raw
+            # text is enough to have it treated as changed.
+            logger.warning("Could not parse the configuration of jenkins "
+                           "job {0}".format(job_name))
         return hashlib.md5(xml).hexdigest()
 
     def delete_job(self, job_name):
         if self.is_job(job_name):
             self.jenkins.delete_job(job_name)
+            self._job_names().discard(job_name)
+
+    def rename_job(self, job_name, new_name):
+        logger.info("Renaming jenkins job {0} to {1}".format(job_name,
+                                                             new_name))
+        self.jenkins.rename_job(job_name, new_name)
+        self._job_names().discard(job_name)
+        self._job_names().add(new_name)
+
+    def get_job_tokens(self, job_name):
+        """Return the configuration of a job as a list of elements, to be
+        compared with :func:`xml_tokens`."""
+        return xml_tokens(self.get_job_config(job_name))
 
     def get_jobs(self):
         return self.jenkins.get_jobs()
 
+    def reload(self):
+        """Have Jenkins reload its configuration from disk."""
+        logger.info("Reloading the configuration of jenkins")
+        self.jenkins.jenkins_open(urllib2.Request(
+            self.jenkins.server + 'reload', ''))
+
+    def _get_job_names(self):
+        names = []
+        for job in self.get_jobs():
+            name = job['name']
+            try:
+                name = str(name)
+            except UnicodeEncodeError:
+                pass
+            names.append(name)
+        return names
+
+    def get_job_names(self):
+        """Return the names of all jobs, as the YAML parser would."""
+        names = self._get_job_names()
+        with self.job_names_lock:
+            self.job_names = set(names)
+        return names
+
 
 class Builder(object):
     def __init__(self, jenkins_url, jenkins_user, jenkins_password,
-                 config=None):
-        self.jenkins = Jenkins(jenkins_url, jenkins_user, jenkins_password)
-        self.cache = CacheStorage()
+                 config=None, section='jenkins'):
+        # The options of the master are read from its section of the
+        # configuration file, as returned by get_masters().
+        timeout = get_master_option(config, section, 'timeout')
+        if timeout is not None:
+            timeout = float(timeout)
+        pool_size = int(get_master_option(config, section, 'pool-size', 8))
+        self.jenkins = Jenkins(jenkins_url, jenkins_user, jenkins_password,
+                               pool_size, timeout)
+        self.script_batch_size = int(get_master_option(
+            config, section, 'script-batch-size', 0))
         self.global_config = config
+        cache_backend = get_config_option(config, 'job_builder',
+                                          'cache-backend', 'yaml')
+        if cache_backend not in CACHE_BACKENDS:
+            raise JenkinsJobsException("Unknown cache-backend '{0}', "
+                                       "expected one of: {1}".format(
+                                           cache_backend,
+                                           ', '.join(sorted(CACHE_BACKENDS))))
+        self.cache = CACHE_BACKENDS[cache_backend](jenkins_url)
+        self.upload_format = get_config_option(config, 'job_builder',
+                                               'upload-format', 'pretty')
+        if self.upload_format not in UPLOAD_FORMATS:
+            raise JenkinsJobsException("Unknown upload-format '{0}', "
+                                       "expected one of: {1}".format(
+                                           self.upload_format,
+                                           ', '.join(UPLOAD_FORMATS)))
+        # The journal of the update being applied, if any
+        self.journal = None
+
+    #: How alike, from 0 to 1, the configurations of an old and a new
+    #: job must be for the new job to be taken as the old one renamed
+    rename_similarity = 0.8
+
+    #: Most pairs of old and new jobs to compare to find renamed jobs
+    rename_comparisons = 100000
 
     def delete_job(self, name):
         self.jenkins.delete_job(name)
         if(self.cache.is_cached(name)):
-            self.cache.set(name, '')
+            self.cache.set(name, '', managed=False)
+
+    def delete_jobs(self, patterns=None, regex=False, workers=1,
+                    dry_run=False, max_rps=None):
+        """Delete the jobs on Jenkins whose names match any of patterns,
+        or all jobs if no patterns are given, up to workers at a time,
+        and return the names of those which could not be deleted.
+
+        Patterns are shell-style wildcards, or regular expressions which
+        must match the whole name if regex is true.  With dry_run, the
+        names of the jobs which would be deleted are printed instead.
+        As for uploads, a :class:`Scheduler` adapts the number of
+        deletions made at once, and the failures are reported together
+        at the end.
+        """
+        names = Scheduler(workers, None, is_transient).call(
+            self.jenkins.get_job_names)
+        if patterns:
+            matches = name_matcher(patterns, regex)
+            names = [name for name in names if matches(name)]
+        if dry_run:
+            for name in names:
+                print name
+            return []
+        return self._delete_jobs(names, workers, max_rps)
+
+    def _delete_jobs(self, names, workers=1, max_rps=None):
+        logger.info("Deleting {0} jobs".format(len(names)))
+        start = time.time()
+        errors = []
+        scheduler = Scheduler(workers, max_rps, is_transient)
+        for name, result, error in run_in_parallel(
+                lambda name: scheduler.call(self.jenkins.delete_job, name),
+                names, workers):
+            if error:
+                logger.error("Could not delete job {0}: {1}".format(
+                    name, error))
+                errors.append((name, error))
+                continue
+            logger.debug("Deleted job {0}".format(name))
+            if self.cache.is_cached(name):
+                self.cache.set(name, '', managed=False)
+        self.cache.save()
+        logger.info("Deleted {0} jobs in {1:.1f}s".format(
+            len(names) - len(errors), time.time() - start))
+        if errors:
+            report = '\n'.join("  {0}: {1}".format(name, error)
+                               for name, error in errors)
+            logger.error("{0} jobs could not be deleted:\n{1}".format(
+                len(errors), report))
+        return [name for name, error in errors]
+
+    def migrate_cache(self):
+        """Copy the YAML cache into the SQLite cache of this master."""
+        if not isinstance(self.cache, SqliteCacheStorage):
+            raise JenkinsJobsException("Migrating the cache requires "
+                                       "cache-backend=sqlite")
+        count = self.cache.migrate(CacheStorage(self.cache.namespace))
+        logger.info("Copied {0} jobs from the YAML cache".format(count))
+
+    def seed_cache(self, workers=1):
+        """Fill the cache with the hashes of every job on Jenkins, fetching
+        the configuration of several jobs at a time."""
+        scheduler = Scheduler(workers, None, is_transient)
+        names = scheduler.call(self.jenkins.get_job_names)
+        logger.info("Fetching the configuration of {0} jobs".format(
+            len(names)))
+        start = time.time()
+        failed = []
+        for name, md5, error in run_in_parallel(
+                lambda name: scheduler.call(self.jenkins.get_job_md5, name),
+                names, workers):
+            if error:
+                logger.error("Could not seed the cache for job {0}: "
+                             "{1}".format(name, error))
+                failed.append(name)
+            else:
+                self.cache.set(name, md5)
+        self.cache.save()
+        elapsed = time.time() - start
+        seeded = len(names) - len(failed)
+        logger.info("Seeded the cache with {0} jobs in {1:.1f}s "
+                    "({2:.1f} jobs/s), {3} failed".format(
+                        seeded, elapsed, seeded / max(elapsed, 0.001),
+                        len(failed)))
+        return failed
+
+    def verify_cache(self, percent, workers=1):
+        """Compare the cached hashes of a random sample of jobs with the
+        jobs on Jenkins, and correct the cache for those which differ so
+        that they are updated.  Sampling on every run catches jobs edited
+        in Jenkins over time without fetching every job on any one run."""
+        if not 0 <= percent <= 100:
+            raise JenkinsJobsException("The sample of jobs to verify must be "
+                                       "between 0 and 100%, not "
+                                       "{0}%".format(percent))
+        # Jobs which are not managed are never updated, so there is no
+        # point in checking them.
+        names = self.cache.managed_jobs()
+        count = int(math.ceil(len(names) * percent / 100.0))
+        sample = random.sample(names, count)
+        logger.info("Verifying the cache against {0} of {1} jobs".format(
+            count, len(names)))
+        scheduler = Scheduler(workers, None, is_transient)
+        self.jenkins.list_jobs(scheduler)
+        mismatched = 0
+        for name, md5, error in run_in_parallel(
+                lambda name: scheduler.call(self.jenkins.get_job_md5, name),
+                sample, workers):
+            if error:
+                if self.jenkins.is_job(name):
+                    logger.warning("Could not verify job {0}: {1}".format(
+                        name, error))
+                    continue
+                logger.info("Job {0} has been deleted from Jenkins".format(
+                    name))
+                md5 = ''
+            elif not self.cache.has_changed(name, md5):
+                continue
+            else:
+                logger.info("Job {0} has been changed in Jenkins".format(
+                    name))
+            # The hash of the job as it is now, without a fingerprint,
+            # makes the next update regenerate and upload it.
+            self.cache.set(name, md5)
+            mismatched += 1
+        logger.info("{0} of {1} verified jobs differed from the "
+                    "cache".format(mismatched, count))
+        return mismatched
+
+    def diff(self, fn, patterns=None, regex=False, workers=8,
+             summary=False):
+        """Print how the jobs defined in fn, or those of them whose names
+        match any of patterns as for :meth:`delete_jobs`, differ from the
+        jobs on Jenkins.  Returns the names of the jobs which differ or
+        could not be compared.
+
+        The configuration of each job is fetched, as many at a time as
+        workers, and compared with the generated one in canonical form,
+        so that differences in formatting are ignored.  The differences
+        are printed as soon as each configuration arrives, as a unified
+        diff, or with summary as a line per job saying whether it is new
+        or how many lines changed.
+        """
+        start = time.time()
+        parser = self.generate(fn)
+        matches = patterns and name_matcher(patterns, regex)
+        scheduler = Scheduler(workers, None, is_transient)
+        self.jenkins.list_jobs(scheduler)
+
+        def jobs():
+            for job in parser.jobs.latest():
+                if not matches or matches(job.name):
+                    yield job
+
+        def compare(job):
+            # Returns the diff of the job, empty if it is up to date, or
+            # None if it is not on Jenkins
+            if not self.jenkins.is_job(job.name):
+                return None
+            xml = scheduler.call(self.jenkins.get_job_config, job.name)
+            try:
+                if hashlib.md5(canonical_xml(xml)).hexdigest() == job.md5():
+                    return []
+                old = canonical_lines(xml)
+            except SyntaxError:
+                old = xml.splitlines()
+            return list(difflib.unified_diff(
+                old, canonical_lines(job.tostring()),
+                'jenkins/' + job.name, 'yaml/' + job.name, lineterm=''))
+
+        compared = 0
+        new = []
+        changed = []
+        failed = []
+        for job, diff, error in run_in_parallel(compare, jobs(), workers):
+            compared += 1
+            if error:
+                logger.error("Could not compare job {0}: {1}".format(
+                    job.name, error))
+                failed.append(job.name)
+                continue
+            if diff is None:
+                new.append(job.name)
+                if summary:
+                    diff = ['new      {0}'.format(job.name)]
+                else:
+                    diff = difflib.unified_diff(
+                        [], canonical_lines(job.tostring()),
+                        'jenkins/' + job.name, 'yaml/' + job.name,
+                        lineterm='')
+            elif not diff:
+                continue
+            else:
+                changed.append(job.name)
+                if summary:
+                    added = sum(1 for line in diff[2:]
+                                if line.startswith('+'))
+                    removed = sum(1 for line in diff[2:]
+                                  if line.startswith('-'))
+                    diff = ['changed  {0} (+{1} -{2})'.format(
+                        job.name, added, removed)]
+            for line in diff:
+                print line
+            sys.stdout.flush()
+        logger.info("Compared {0} jobs in {1:.1f}s: {2} new, {3} changed, "
+                    "{4} could not be compared".format(
+                        compared, time.time() - start, len(new),
+                        len(changed), len(failed)))
+        return new + changed + failed
+
+    def drift(self, fn, workers=8, refresh_cache=False):
+        """Compare each job managed by jenkins-jobs as it is on Jenkins
+        and as it is defined in fn with the hash the cache holds for it,
+        that of the job as last updated.  Returns a dict of the names of
+        the jobs which were:
+
+        * ``server``: changed on Jenkins
+        * ``yaml``: changed in their definition, or no longer defined
+        * ``both``: changed on Jenkins and in their definition
+        * ``missing``: deleted from Jenkins
+        * ``failed``: could not be fetched from Jenkins
+
+        The configurations are fetched as many at a time as workers.
+        With refresh_cache, the hashes of the jobs changed or deleted on
+        Jenkins are recorded in the cache, without a fingerprint, so
+        that the next update puts them back as they are defined.
+        """
+        start = time.time()
+        parser = self.generate(fn)
+        generated = dict((job.name, job.md5())
+                         for job in parser.jobs.latest())
+        managed = self.cache.managed_jobs()
+        scheduler = Scheduler(workers, None, is_transient)
+        self.jenkins.list_jobs(scheduler)
+        report = dict((kind, []) for kind in
+                      ('server', 'yaml', 'both', 'missing', 'failed'))
+
+        def fetch(name):
+            if not self.jenkins.is_job(name):
+                return None
+            return scheduler.call(self.jenkins.get_job_md5, name)
+
+        for name, md5, error in run_in_parallel(fetch, managed, workers):
+            if error:
+                logger.error("Could not check job {0}: {1}".format(
+                    name, error))
+                report['failed'].append(name)
+                continue
+            cached = self.cache.get(name)
+            if md5 is None:
+                report['missing'].append(name)
+                md5 = ''
+            else:
+                on_server = md5 != cached
+                in_yaml = generated.get(name) != cached
+                if on_server and in_yaml:
+                    report['both'].append(name)
+                elif on_server:
+                    report['server'].append(name)
+                elif in_yaml:
+                    report['yaml'].append(name)
+                if not on_server:
+                    continue
+            if refresh_cache:
+                self.cache.set(name, md5)
+        if refresh_cache:
+            self.cache.save()
+        for names in report.itervalues():
+            names.sort()
+        logger.info("Checked {0} jobs in {1:.1f}s: {2} changed on jenkins, "
+                    "{3} in their definition, {4} in both, {5} missing, "
+                    "{6} failed".format(
+                        len(managed), time.time() - start,
+                        len(report['server']), len(report['yaml']),
+                        len(report['both']), len(report['missing']),
+                        len(report['failed'])))
+        return report
 
-    def delete_all_jobs(self):
-        jobs = self.jenkins.get_jobs()
-        for job in jobs:
-            self.delete_job(job['name'])
+    def upload_xml(self, job):
+        if self.upload_format == 'compact':
+            return job.compact_output()
+        return job.output()
 
-    def update_job(self, fn, names=None, output_dir=None):
+    def generate(self, fn, cache=None):
+        """Parse the YAML file fn, or the YAML files in directory fn, and
+        return the parser with the jobs generated from them."""
         if os.path.isdir(fn):
             files_to_process = [os.path.join(fn, f)
                                 for f in os.listdir(fn)
                                 if (f.endswith('.yml') or f.endswith('.yaml'))]
         else:
             files_to_process = [fn]
-        parser = YamlParser(self.global_config)
+        parser = YamlParser(self.global_config, cache)
         for in_file in files_to_process:
             logger.debug("Parsing YAML file {0}".format(in_file))
             parser.parse(in_file)
-        parser.generateXML()
+        parser.generateXML(self._is_jobs_root(fn))
+        return parser
 
-        parser.jobs.sort(lambda a, b: cmp(a.name, b.name))
+    def _is_jobs_root(self, fn):
+        # Whether fn holds the definitions of every job
+        jobs_root = get_config_option(self.global_config, 'job_builder',
+                                      'jobs-root')
+        return (jobs_root is not None and
+                os.path.realpath(fn) == os.path.realpath(jobs_root))
 
-        for job in parser.jobs:
-            if names and job.name not in names:
-                continue
-            if output_dir:
+    def update_job(self, fn, names=None, output_dir=None, workers=1,
+                   max_rps=None, delete_old=False, detect_renames=False,
+                   resume=False):
+        if output_dir:
+            # Test output is always generated in full
+            parser = self.generate(fn)
+            for job in parser.jobs:
+                if names and job.name not in names:
+                    continue
                 if names:
                     print job.output()
                     continue
@@ -340,15 +1741,653 @@ class Builder(object):
                 f = open(fn, 'w')
                 f.write(job.output())
                 f.close()
-                continue
-            md5 = job.md5()
-            if (self.jenkins.is_job(job.name)
-                and not self.cache.is_cached(job.name)):
-                old_md5 = self.jenkins.get_job_md5(job.name)
-                self.cache.set(job.name, old_md5)
-
-            if self.cache.has_changed(job.name, md5):
-                self.jenkins.update_job(job.name, job.output())
-                self.cache.set(job.name, md5)
+            return []
+
+        self._check_plan_options(fn, names, delete_old, detect_renames)
+        journal = self.prepare_update(lambda: self.generate(fn, self.cache),
+                                      names, delete_old, detect_renames,
+                                      workers, resume)
+        return self.finish_update(journal, workers, max_rps)
+
+    def _check_plan_options(self, fn, names, delete_old, detect_renames):
+        # Old and renamed jobs are those which are not defined in fn, so
+        # fn must hold every definition.
+        if delete_old and names:
+            raise JenkinsJobsException("Old jobs can only be deleted when "
+                                       "all jobs are updated, not with job "
+                                       "names")
+        if detect_renames and names:
+            raise JenkinsJobsException("Renamed jobs can only be detected "
+                                       "when all jobs are updated, not with "
+                                       "job names")
+        if not (delete_old or detect_renames):
+            return
+        jobs_root = get_config_option(self.global_config, 'job_builder',
+                                      'jobs-root')
+        if jobs_root is None:
+            raise JenkinsJobsException("Old jobs can only be deleted, or "
+                                       "renamed jobs detected, once "
+                                       "jobs-root is set in the job_builder "
+                                       "section")
+        if os.path.realpath(fn) != os.path.realpath(jobs_root):
+            raise JenkinsJobsException("Old jobs can only be deleted, or "
+                                       "renamed jobs detected, when all jobs "
+                                       "are updated from {0}, not from "
+                                       "{1}".format(jobs_root, fn))
+
+    def prepare_update(self, parse, names=None, delete_old=False,
+                       detect_renames=False, workers=1, resume=False):
+        """Plan an update into the journal of the Jenkins server, unless
+        resume is true and the journal holds an interrupted update, and
+        return the journal for :meth:`finish_update`.  parse() is only
+        called if a plan is needed, and returns the parser with the
+        generated jobs."""
+        # The update is planned and applied through a journal, which is
+        # only removed once it is over, so that an update which dies
+        # halfway can be resumed.
+        journal = Journal(self.cache.get_cache_dir(),
+                          self.jenkins.jenkins.server)
+        if resume and journal.exists():
+            logger.info("Resuming the interrupted update of {0}".format(
+                self.jenkins.jenkins.server))
+            return journal
+        if resume:
+            logger.warning("There is no interrupted update to resume, "
+                           "updating all jobs")
+        elif journal.exists():
+            logger.info("Discarding an interrupted update, which --resume "
+                        "would have finished")
+        journal.create(lambda plan: self.write_plan(
+            parse(), plan, names, delete_old, detect_renames, workers))
+        return journal
+
+    def finish_update(self, journal, workers=1, max_rps=None):
+        """Apply the update planned in journal, and remove the journal
+        once it is over.  Returns the names of the jobs which could not
+        be changed."""
+        self.journal = journal
+        try:
+            with journal.open() as plan:
+                failed = self.apply(plan, workers, max_rps)
+        finally:
+            self.journal = None
+            journal.close()
+        journal.remove()
+        return failed
+
+    def plan(self, fn, output, names=None, delete_old=False,
+             detect_renames=False, workers=1):
+        """Work out the changes updating the jobs defined in fn would make,
+        and write them to the file object output as a plan for
+        :meth:`apply`.  Returns a Counter of the changes by action.
+
+        The jobs are compared with the cache and, for jobs it does not
+        know, with their configuration on Jenkins, as many at a time as
+        workers.  Nothing is changed on Jenkins or in the cache.  The
+        plan holds the configuration of each job to upload, so it can be
+        applied later, or from another machine, without the YAML files.
+        """
+        self._check_plan_options(fn, names, delete_old, detect_renames)
+        return self.write_plan(self.generate(fn, self.cache), output, names,
+                               delete_old, detect_renames, workers)
+
+    def write_plan(self, parser, output, names=None, delete_old=False,
+                   detect_renames=False, workers=1):
+        """Write the plan of the changes to make for the jobs generated
+        by parser to the file object output, as :meth:`plan` does."""
+        writer = PlanWriter(output, {
+            'url': self.jenkins.jenkins.server,
+            'version': version_info.version_string(),
+            'created': int(time.time()),
+        })
+
+        # Jobs are listed and fetched from Jenkins through a scheduler,
+        # which retries transient errors
+        scheduler = Scheduler(workers, None, is_transient)
+        self.jenkins.list_jobs(scheduler)
+        generated = set(parser.unchanged)
+        # The cached hash of each renamed job, under its new name
+        renamed = {}
+        if detect_renames:
+            new = []
+            for job in parser.jobs.latest():
+                generated.add(job.name)
+                if not self.jenkins.is_job(job.name):
+                    new.append(job)
+            old = set(self.cache.managed_jobs()) - generated
+            for name, job in self.plan_renames(old, new, workers,
+                                               scheduler):
+                logger.info("Job {0} was renamed to {1}".format(name,
+                                                                job.name))
+                writer.write(Change('rename', name, new_name=job.name))
+                renamed[job.name] = self.cache.get(name)
+                generated.add(name)
+
+        def jobs():
+            for job in parser.jobs.latest():
+                if not names or job.name in names:
+                    generated.add(job.name)
+                    yield job
+
+        for job, change, error in run_in_parallel(
+                lambda job: self._plan_job(job, renamed, scheduler), jobs(),
+                workers):
+            if error:
+                raise error
+            writer.write(change)
+        if parser.unchanged:
+            logger.info("Skipped {0} jobs whose definition has not changed "
+                        "since they were last updated".format(
+                            len(parser.unchanged)))
+            # Only jobs uploaded by jenkins-jobs have a fingerprint
+            for name in sorted(parser.unchanged):
+                if not self.cache.is_managed(name):
+                    writer.write(Change('keep', name))
+        if delete_old:
+            for name in self.old_jobs(generated):
+                logger.info("Job {0} is no longer defined".format(name))
+                writer.write(Change('delete', name))
+        writer.close()
+        logger.info("Planned {0} renames, {1} creations, {2} updates and "
+                    "{3} deletions".format(
+                        writer.counts['rename'], writer.counts['create'],
+                        writer.counts['update'], writer.counts['delete']))
+        return writer.counts
+
+    def _plan_job(self, job, renamed, scheduler):
+        # Called from the worker threads of plan, which only read the
+        # cache.
+        md5 = job.md5()
+        if job.name in renamed:
+            # Renamed jobs keep their old configuration until updated
+            changed = renamed[job.name] != md5
+            action = 'update'
+        elif not self.jenkins.is_job(job.name):
+            changed = True
+            action = 'create'
+        elif not self.cache.is_cached(job.name):
+            try:
+                changed = scheduler.call(self.jenkins.get_job_md5,
+                                         job.name) != md5
+            except Exception, e:
+                logger.warning("Could not compare job {0} with its "
+                               "configuration on jenkins, updating it: "
+                               "{1}".format(job.name, e))
+                changed = True
+            action = 'update'
+        else:
+            changed = self.cache.has_changed(job.name, md5)
+            action = 'update'
+        if not changed:
+            logger.debug("'{0}' has not changed".format(job.name))
+            return Change('keep', job.name, md5=md5,
+                          fingerprint=job.fingerprint, source=job.source)
+        return Change(action, job.name, md5=md5, fingerprint=job.fingerprint,
+                      source=job.source, xml=self.upload_xml(job))
+
+    def apply(self, plan, workers=1, max_rps=None):
+        """Make the changes of a plan written by :meth:`plan`, read from
+        the file object plan, and return the names of the jobs which
+        could not be changed.
+
+        Jobs are renamed first, then uploaded, up to workers at a time
+        as by :meth:`upload_jobs`, then deleted.  The plan must have been
+        made for the Jenkins server of this builder.  Jobs are not
+        compared again: a job changed on Jenkins since the plan was made
+        is overwritten.
+
+        When applied through a journal which already holds events, the
+        changes an interrupted update made are only recorded in the
+        cache.  The configuration of jobs which were being uploaded when
+        it was interrupted is fetched to tell whether they need to be
+        uploaded again.
+        """
+        header, changes = read_plan(plan)
+        if header.get('url') != self.jenkins.jenkins.server:
+            raise JenkinsJobsException("The plan was made for {0}, not "
+                                       "{1}".format(
+                                           header.get('url'),
+                                           self.jenkins.jenkins.server))
+        self.jenkins.list_jobs(Scheduler(workers, max_rps, is_transient))
+        if self.journal:
+            done, started = self.journal.read()
+            if done or started:
+                changes = self._skip_done(changes, done, started)
+        failed = []
+        not_renamed = set()
+        for phase, group in itertools.groupby(changes,
+                                              lambda change: change.phase):
+            if phase == PHASES['rename']:
+                renames = [(change.name, change.new_name) for change in group]
+                errors = set(self.rename_jobs(renames))
+                failed.extend(errors)
+                not_renamed.update(new_name for name, new_name in renames
+                                   if name in errors)
+            elif phase == PHASES['delete']:
+                failed.extend(self.delete_old_jobs(
+                    [change.name for change in group], workers, max_rps))
             else:
-                logger.debug("'{0}' has not changed".format(job.name))
+                failed.extend(self.upload_jobs(
+                    self._keep_jobs(group, not_renamed), workers, max_rps))
+        return failed
+
+    def _skip_done(self, changes, done, started):
+        # Turns the changes an interrupted update made into cache records
+        for change in changes:
+            if change.action == 'rename':
+                if (not self.jenkins.is_job(change.name) and
+                        self.jenkins.is_job(change.new_name)):
+                    self._renamed(change.name, change.new_name)
+                    continue
+            elif change.action in ('create', 'update'):
+                if change.name in started:
+                    try:
+                        if (self.jenkins.is_job(change.name) and
+                                self.jenkins.get_job_md5(change.name) ==
+                                change.md5):
+                            done.add(change.name)
+                    except Exception, e:
+                        logger.warning("Could not check whether job {0} "
+                                       "was updated: {1}".format(
+                                           change.name, e))
+                if change.name in done:
+                    change = Change('keep', change.name, md5=change.md5,
+                                    fingerprint=change.fingerprint,
+                                    source=change.source)
+            yield change
+
+    def _record(self, event, name):
+        if self.journal:
+            self.journal.record(event, name)
+
+    def _keep_jobs(self, changes, not_renamed):
+        # Records the jobs which are up to date in the cache, and yields
+        # the others to be uploaded
+        for change in changes:
+            if change.name in not_renamed:
+                logger.error("Not updating job {0}, the job it was renamed "
+                             "from could not be renamed".format(change.name))
+            elif change.action != 'keep':
+                yield change
+            elif change.md5 is None:
+                self.cache.mark_managed(change.name)
+            else:
+                self.cache.set(change.name, change.md5, change.fingerprint,
+                               True, change.source)
+
+    def plan_renames(self, old, new, workers=1, scheduler=None):
+        """Match jobs which are no longer defined, old, with jobs which
+        do not exist yet, new, and return a list of (old name, new job)
+        pairs of the jobs which were renamed.
+
+        A job with the same configuration as an old job, generated from
+        the same template and parameters or the only one with that
+        configuration, is taken to be that job renamed.  Otherwise, the
+        configurations of the remaining old jobs are fetched and
+        compared with those of the new jobs from the same source, or any
+        new job if either source is not known; the most similar pairs,
+        if they are at least :attr:`rename_similarity` alike, are taken
+        to be renames.  The configurations are fetched through scheduler,
+        or a new :class:`Scheduler`, up to workers at a time.
+        """
+        def old_source(name):
+            source = self.cache.get_source(name)
+            return source and (source, self.cache.get(name))
+
+        def new_source(job):
+            return job.source and (job.source, job.md5())
+
+        old = [name for name in old if self.jenkins.is_job(name)]
+        new = list(new)
+        renames = []
+        for old_key, new_key in ((old_source, new_source),
+                                 (self.cache.get, lambda job: job.md5())):
+            pairs = unique_pairs(old, new, old_key, new_key)
+            renames.extend(pairs)
+            renamed = set(name for name, job in pairs)
+            old = [name for name in old if name not in renamed]
+            renamed = set(job.name for name, job in pairs)
+            new = [job for job in new if job.name not in renamed]
+        if not old or not new:
+            return renames
+        if len(old) * len(new) > self.rename_comparisons:
+            logger.warning("Not comparing {0} old jobs with {1} new jobs to "
+                           "find renamed jobs, there are too many".format(
+                               len(old), len(new)))
+            return renames
+
+        new_tokens = [(job, xml_tokens(job.tostring())) for job in new]
+        candidates = []
+        scheduler = scheduler or Scheduler(workers, None, is_transient)
+        for name, tokens, error in run_in_parallel(
+                lambda name: scheduler.call(self.jenkins.get_job_tokens, name),
+                old, workers):
+            if error:
+                logger.warning("Could not compare job {0} with the new "
+                               "jobs: {1}".format(name, error))
+                continue
+            source = self.cache.get_source(name)
+            for job, job_tokens in new_tokens:
+                if (source is not None and job.source is not None and
+                        source != job.source):
+                    continue
+                matcher = difflib.SequenceMatcher(None, tokens, job_tokens)
+                if matcher.real_quick_ratio() < self.rename_similarity:
+                    continue
+                ratio = matcher.ratio()
+                if ratio >= self.rename_similarity:
+                    candidates.append((ratio, name, job))
+        renamed = set()
+        for ratio, name, job in sorted(candidates, reverse=True):
+            if name not in renamed and job.name not in renamed:
+                renamed.update((name, job.name))
+                renames.append((name, job))
+        return renames
+
+    def rename_jobs(self, renames):
+        """Rename jobs on Jenkins and in the cache, and return the names
+        of the jobs which could not be renamed.  renames is a list of
+        (old name, new name) pairs."""
+        failed = []
+        for name, new_name in renames:
+            try:
+                self.jenkins.rename_job(name, new_name)
+            except Exception, e:
+                logger.error("Could not rename job {0} to {1}: {2}".format(
+                    name, new_name, e))
+                failed.append(name)
+                continue
+            self._renamed(name, new_name)
+        self.cache.save()
+        return failed
+
+    def _renamed(self, name, new_name):
+        if not self.cache.is_managed(name):
+            # Already moved before an update was interrupted
+            return
+        # The job keeps its old configuration until it is updated
+        self.cache.set(new_name, self.cache.get(name), None, True)
+        self.cache.set(name, '', managed=False)
+
+    def old_jobs(self, generated):
+        """Return the names of the jobs managed by jenkins-jobs which are
+        not among the names of the generated jobs, as their definition
+        was removed."""
+        old = set(self.cache.managed_jobs()) - set(generated)
+        if old and not generated:
+            raise JenkinsJobsException("No jobs were generated, refusing to "
+                                       "delete all {0} managed jobs".format(
+                                           len(old)))
+        return sorted(old)
+
+    def delete_old_jobs(self, names, workers=1, max_rps=None):
+        """Delete the jobs which are no longer defined, as found by
+        :meth:`old_jobs`, and return the names of those which could not
+        be deleted."""
+        old = []
+        # Jobs already deleted from Jenkins by other means only need to
+        # be forgotten
+        for name in names:
+            if self.jenkins.is_job(name):
+                old.append(name)
+                continue
+            logger.info("Job {0} is no longer on Jenkins".format(name))
+            self.cache.set(name, '', managed=False)
+        logger.info("Deleting {0} jobs which are no longer defined".format(
+            len(old)))
+        return self._delete_jobs(old, workers, max_rps)
+
+    def provision(self, fn, jenkins_home, names=None, reload=False):
+        """Write the configuration of the jobs defined in fn straight into
+        the jobs directory of jenkins_home, skipping those whose
+        configuration file is already up to date.  Jenkins only sees the
+        changes once it reloads its configuration, which is requested
+        when reload is true.  Returns the names of the jobs written."""
+        jobs_dir = os.path.join(jenkins_home, 'jobs')
+        if not os.path.isdir(jobs_dir):
+            raise JenkinsJobsException("No jobs directory in {0}".format(
+                jenkins_home))
+        start = time.time()
+        parser = self.generate(fn)
+        written = []
+        unchanged = 0
+        for job in parser.jobs.latest():
+            if names and job.name not in names:
+                continue
+            if job.name in ('.', '..') or os.sep in job.name:
+                raise JenkinsJobsException("Cannot provision job {0}, its "
+                                           "name is not a valid directory "
+                                           "name".format(job.name))
+            job_dir = os.path.join(jobs_dir, job.name)
+            filename = os.path.join(job_dir, 'config.xml')
+            xml = self.upload_xml(job)
+            try:
+                with open(filename, 'rb') as config_file:
+                    old_xml = config_file.read()
+            except IOError:
+                old_xml = None
+            if old_xml is not None:
+                if old_xml == xml:
+                    unchanged += 1
+                    continue
+                try:
+                    same = hashlib.md5(
+                        canonical_xml(old_xml)).hexdigest() == job.md5()
+                except SyntaxError:
+                    same = False
+                if same:
+                    unchanged += 1
+                    continue
+            if not os.path.isdir(job_dir):
+                os.mkdir(job_dir)
+                give_to_owner(os.chown, job_dir, os.stat(jobs_dir))
+            logger.debug("Writing XML to '{0}'".format(filename))
+            write_file_atomically(filename, lambda f: f.write(xml))
+            written.append(job.name)
+        logger.info("Wrote {0} jobs to {1} in {2:.1f}s, {3} were up to "
+                    "date".format(len(written), jobs_dir,
+                                  time.time() - start, unchanged))
+        if reload and written:
+            self.jenkins.reload()
+        return written
+
+    def _upload_job(self, change):
+        self._record('started', change.name)
+        self.jenkins.update_job(change.name, change.xml)
+
+    def _upload_batch(self, batch):
+        # Returns whether each job of the batch was uploaded; those which
+        # were not are to be uploaded one at a time instead.
+        if len(batch) == 1 or not self.script_batch_size:
+            return [(change, False) for change in batch]
+        for change in batch:
+            self._record('started', change.name)
+        outcome = self.jenkins.update_jobs_by_script(
+            [(change.name, change.xml) for change in batch])
+        results = []
+        for change in batch:
+            if change.name in outcome and outcome[change.name] is not None:
+                logger.warning("Could not update job {0} through the "
+                               "script console: {1}".format(
+                                   change.name, outcome[change.name]))
+            results.append((change, change.name in outcome and
+                            outcome[change.name] is None))
+        return results
+
+    def _upload_batches(self, changes, scheduler, workers):
+        # Returns the number of jobs uploaded and the jobs which could
+        # not be uploaded in batches; the others are recorded in the
+        # cache.  Once the script console is found to be refused, the
+        # remaining jobs are left to be uploaded one at a time.
+        batch_size = self.script_batch_size
+
+        def batches():
+            while self.script_batch_size:
+                batch = list(itertools.islice(changes, batch_size))
+                if not batch:
+                    return
+                yield batch
+
+        uploaded = 0
+        fallback = []
+        for batch, results, error in run_in_parallel(
+                lambda batch: scheduler.call(self._upload_batch, batch),
+                batches(), workers):
+            if error:
+                logger.warning("Could not update {0} jobs through the script "
+                               "console, updating them one at a time: "
+                               "{1}".format(len(batch), error))
+                if isinstance(error, NoScriptConsoleError) or (
+                        isinstance(error, HTTPError) and
+                        error.code in (403, 405)):
+                    # No script console, or not allowed to use it at all
+                    self.script_batch_size = 0
+                fallback.extend(batch)
+                continue
+            for change, done in results:
+                if not done:
+                    fallback.append(change)
+                    continue
+                self.cache.set(change.name, change.md5, change.fingerprint,
+                               True, change.source)
+                self._record('done', change.name)
+                uploaded += 1
+        return uploaded, itertools.chain(fallback, changes)
+
+    def upload_jobs(self, changes, workers=1, max_rps=None):
+        """Upload the jobs of the create and update changes, up to
+        workers at a time, and return the names of those which could not
+        be uploaded.
+
+        The number of uploads made at once is adapted to the server by a
+        :class:`Scheduler`, which also retries transient errors; max_rps
+        limits the number of jobs processed each second.  A failure does
+        not stop the other uploads; the failures are logged and reported
+        together at the end.  With script-batch-size set, the jobs of
+        each batch are uploaded with a single script console request,
+        and those for which that fails one at a time.
+
+        Each job may only be given once, as in a plan, so that no two
+        uploads of a job can overtake each other.
+        """
+        start = time.time()
+        uploaded = 0
+        errors = []
+        scheduler = Scheduler(workers, max_rps, is_transient)
+        if self.script_batch_size:
+            uploaded, changes = self._upload_batches(iter(changes),
+                                                     scheduler, workers)
+        for change, result, error in run_in_parallel(
+                lambda change: scheduler.call(self._upload_job, change),
+                changes, workers):
+            if error:
+                logger.error("Could not update job {0}: {1}".format(
+                    change.name, error))
+                errors.append((change.name, error))
+                self._record('failed', change.name)
+                continue
+            self.cache.set(change.name, change.md5, change.fingerprint, True,
+                           change.source)
+            self._record('done', change.name)
+            uploaded += 1
+        self.cache.save()
+        logger.info("Uploaded {0} jobs in {1:.1f}s with up to {2} at "
+                    "once, {3} retries".format(
+                        uploaded, time.time() - start,
+                        int(scheduler.limit), scheduler.retried))
+        if errors:
+            report = '\n'.join("  {0}: {1}".format(name, error)
+                               for name, error in errors)
+            logger.error("{0} jobs could not be updated:\n{1}".format(
+                len(errors), report))
+        return [name for name, error in errors]
+
+
+class SharedFingerprints(object):
+    """The fingerprints several caches agree on, so that a parser given
+    this as its cache only skips the jobs which none of the caches needs
+    to be generated."""
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def get_fingerprint(self, job):
+        fingerprints = set(cache.get_fingerprint(job)
+                           for cache in self.caches)
+        if len(fingerprints) == 1:
+            return fingerprints.pop()
+        return None
+
+
+def update_masters(builders, fn, names=None, workers=1, max_rps=None,
+                   delete_old=False, detect_renames=False, resume=False):
+    """Update the jobs defined in fn on several Jenkins masters.
+    builders is a list of (name, builder) pairs, one for each master.
+    Returns a dict of the name of each master to the names of the jobs
+    which could not be changed on it, or None if it could not be updated
+    at all.
+
+    The jobs are generated once for all masters.  Each master is then
+    compared with its own cache, as by :meth:`Builder.update_job`, and
+    the masters are updated at the same time, each with up to workers
+    uploads at once.  A master which cannot be planned or updated does
+    not stop the others.  Each cache must be kept apart from the others,
+    so the YAML cache, shared by every master, cannot be used.
+    """
+    for name, builder in builders:
+        if not isinstance(builder.cache, SqliteCacheStorage):
+            raise JenkinsJobsException("Updating several masters needs "
+                                       "cache-backend=sqlite, the YAML "
+                                       "cache is shared by every master")
+        builder._check_plan_options(fn, names, delete_old, detect_renames)
+    parsed = []
+
+    def parse():
+        if not parsed:
+            cache = SharedFingerprints([builder.cache
+                                        for name, builder in builders])
+            parsed.append(builders[0][1].generate(fn, cache))
+        return parsed[0]
+
+    # Plans are written one master at a time, as the generated jobs can
+    # only be iterated by one thread at a time.
+    updates = []
+    results = {}
+    errors = {}
+    for name, builder in builders:
+        logger.info("Planning the update of master {0} ({1})".format(
+            name, builder.jenkins.jenkins.server))
+        try:
+            journal = builder.prepare_update(parse, names, delete_old,
+                                             detect_renames, workers, resume)
+        except JenkinsJobsException:
+            raise
+        except Exception, e:
+            logger.error("Could not plan the update of master {0}: "
+                         "{1}".format(name, e))
+            errors[name] = e
+            results[name] = None
+            continue
+        updates.append((name, builder, journal))
+
+    for update, failed, error in run_in_parallel(
+            lambda update: update[1].finish_update(update[2], workers,
+                                                   max_rps),
+            updates, len(updates)):
+        name = update[0]
+        if error:
+            logger.error("Could not update master {0}: {1}".format(
+                name, error))
+            errors[name] = error
+        results[name] = failed
+    for name, builder in builders:
+        if name in errors:
+            summary = 'failed, {0}'.format(errors[name])
+        elif results[name]:
+            summary = '{0} jobs could not be changed'.format(
+                len(results[name]))
+        else:
+            summary = 'done'
+        logger.info("Master {0} ({1}): {2}".format(
+            name, builder.jenkins.jenkins.server, summary))
+    return results
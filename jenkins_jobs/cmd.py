@@ -2,10 +2,13 @@
 
 import jenkins_jobs.builder
 import jenkins_jobs.errors
+import jenkins_jobs.files
 import argparse
 import ConfigParser
+import json
 import logging
 import os
+import signal
 import sys
 
 
@@ -15,25 +18,164 @@ def confirm(question):
         sys.exit('Aborted')
 
 
+def percentage(value):
+    percent = float(value)
+    if not 0 <= percent <= 100:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a percentage between 0 and 100".format(value))
+    return percent
+
+
+def exit_on_signal(signum, frame):
+    # Exit normally, so that pending cache changes are saved
+    sys.exit('Terminated by signal {0}'.format(signum))
+
+
 def main():
     parser = argparse.ArgumentParser()
-    subparser = parser.add_subparsers(help='update, test or delete job',
+    subparser = parser.add_subparsers(help='update, plan, apply, diff, '
+                                      'drift, test, provision or delete '
+                                      'job, or manage the cache',
                                       dest='command')
     parser_update = subparser.add_parser('update')
     parser_update.add_argument('path', help='Path to YAML file or directory')
     parser_update.add_argument('names', help='name(s) of job(s)', nargs='?')
+    parser_update.add_argument('--verify-sample', dest='verify_sample',
+                               type=percentage, metavar='P',
+                               help='before updating, check P%% of the '
+                               'managed jobs against Jenkins and update '
+                               'those which were changed there')
+    parser_update.add_argument('--fetch-workers', dest='fetch_workers',
+                               type=int, default=8,
+                               help='number of job configurations to fetch '
+                               'from Jenkins at once (default: %(default)s)')
+    parser_update.add_argument('--resume', action='store_true',
+                               help='finish the last update of the '
+                               'configured server, if it was interrupted, '
+                               'rather than starting a new one')
+    parser_plan = subparser.add_parser(
+        'plan', help='Write the changes an update would make to a plan '
+        'file, without making them.')
+    parser_plan.add_argument('path', help='Path to YAML file or directory')
+    parser_plan.add_argument('names', help='name(s) of job(s)', nargs='?')
+    parser_plan.add_argument('-o', dest='output', required=True,
+                             help='Path to write the plan to')
+    parser_plan.add_argument('--workers', type=int, default=8,
+                             help='number of jobs to compare with Jenkins '
+                             'at once (default: %(default)s)')
+    parser_apply = subparser.add_parser(
+        'apply', help='Make the changes of a plan file.')
+    parser_apply.add_argument('plan', help='Path to the plan file')
+    for parser_planning in (parser_update, parser_plan):
+        parser_planning.add_argument('--delete-old', dest='delete_old',
+                                     action='store_true',
+                                     help='delete the jobs previously '
+                                     'updated by jenkins-jobs which are no '
+                                     'longer defined')
+        parser_planning.add_argument('--detect-renames',
+                                     dest='detect_renames',
+                                     action='store_true',
+                                     help='rename the jobs previously '
+                                     'updated by jenkins-jobs which are no '
+                                     'longer defined to the new jobs they '
+                                     'appear to have become, rather than '
+                                     'creating the new jobs')
+    for parser_uploading in (parser_update, parser_apply):
+        parser_uploading.add_argument('--upload-workers',
+                                      dest='upload_workers', type=int,
+                                      default=1,
+                                      help='maximum number of jobs to upload '
+                                      'to Jenkins at once (default: '
+                                      '%(default)s)')
+        parser_uploading.add_argument('--max-rps', dest='max_rps',
+                                      type=float,
+                                      help='maximum number of jobs to upload '
+                                      'each second')
+    parser_diff = subparser.add_parser(
+        'diff', help='Show how the jobs on Jenkins differ from their '
+        'definition.')
+    parser_diff.add_argument('path', help='Path to YAML file or directory')
+    parser_diff.add_argument('names', nargs='*',
+                             help='name of job, or shell-style pattern '
+                             'matching the names of the jobs to compare')
+    parser_diff.add_argument('--regex', action='store_true',
+                             help='the names are regular expressions '
+                             'matching the whole names of the jobs')
+    parser_diff.add_argument('--summary', action='store_true',
+                             help='only list the jobs which differ')
+    parser_diff.add_argument('--workers', type=int, default=8,
+                             help='number of configurations to fetch at '
+                             'once (default: %(default)s)')
+    parser_drift = subparser.add_parser(
+        'drift', help='Report the managed jobs changed on Jenkins or in '
+        'their definition since they were last updated.')
+    parser_drift.add_argument('path', help='Path to YAML file or directory')
+    parser_drift.add_argument('--json', action='store_true',
+                              help='print the report as JSON')
+    parser_drift.add_argument('--refresh-cache', dest='refresh_cache',
+                              action='store_true',
+                              help='record the jobs changed on Jenkins in '
+                              'the cache, so that the next update puts '
+                              'them back as defined')
+    parser_drift.add_argument('--workers', type=int, default=8,
+                              help='number of configurations to fetch at '
+                              'once (default: %(default)s)')
     parser_test = subparser.add_parser('test')
     parser_test.add_argument('path', help='Path to YAML file or directory')
     parser_test.add_argument('-o', dest='output_dir',
                              help='Path to output XML')
     parser_test.add_argument('name', help='name of job', nargs='?')
+    parser_provision = subparser.add_parser(
+        'provision', help='Write jobs directly into the jobs directory of '
+        'a Jenkins server.')
+    parser_provision.add_argument('path',
+                                  help='Path to YAML file or directory')
+    parser_provision.add_argument('names', help='name(s) of job(s)',
+                                  nargs='*')
+    parser_provision.add_argument('--jenkins-home', dest='jenkins_home',
+                                  required=True,
+                                  help='JENKINS_HOME directory to write to')
+    parser_provision.add_argument('--reload', action='store_true',
+                                  help='have the configured Jenkins server '
+                                  'reload its configuration from disk '
+                                  'afterwards')
     parser_delete = subparser.add_parser('delete')
-    parser_delete.add_argument('name', help='name of job', nargs='+')
-    subparser.add_parser('delete-all',
-                         help='Delete *ALL* jobs from Jenkins server, '
-                         'including those not managed by Jenkins Job '
-                         'Builder.')
+    parser_delete.add_argument('name', nargs='+',
+                               help='name of job, or shell-style pattern '
+                               'matching the names of the jobs to delete')
+    parser_delete.add_argument('--regex', action='store_true',
+                               help='the names are regular expressions '
+                               'matching the whole names of the jobs')
+    parser_delete_all = subparser.add_parser(
+        'delete-all', help='Delete *ALL* jobs from Jenkins server, '
+        'including those not managed by Jenkins Job Builder.')
+    for parser_deleting in (parser_delete, parser_delete_all):
+        parser_deleting.add_argument('--dry-run', dest='dry_run',
+                                     action='store_true',
+                                     help='only list the jobs which would '
+                                     'be deleted')
+        parser_deleting.add_argument('--workers', type=int, default=1,
+                                     help='maximum number of jobs to '
+                                     'delete at once (default: '
+                                     '%(default)s)')
+    parser_cache = subparser.add_parser('cache',
+                                        help='Manage the job cache')
+    cache_subparser = parser_cache.add_subparsers(dest='cache_command')
+    cache_subparser.add_parser('migrate',
+                               help='Copy the YAML cache into the SQLite '
+                               'cache of the configured Jenkins server.')
+    parser_seed = cache_subparser.add_parser(
+        'seed', help='Fill the cache with the jobs currently on the '
+        'Jenkins server.')
+    parser_seed.add_argument('--workers', type=int, default=8,
+                             help='number of configurations to fetch at '
+                             'once (default: %(default)s)')
     parser.add_argument('--conf', dest='conf', help='Configuration file')
+    parser.add_argument('--master', dest='masters', action='append',
+                        metavar='NAME',
+                        help='Jenkins master of the configuration file to '
+                        'use, may be given several times (default: every '
+                        'master for update, the default master otherwise)')
     parser.add_argument('-l', '--log_level', dest='log_level', default='info',
                         help="Log level (default: %(default)s)")
     options = parser.parse_args()
@@ -58,32 +200,117 @@ def main():
         conffp = open(conf, 'r')
         config = ConfigParser.ConfigParser()
         config.readfp(conffp)
-    elif options.command == 'test':
-        logger.debug("Not reading config for test output generation")
+    elif options.command == 'test' or (options.command == 'provision' and
+                                       not options.reload):
+        logger.debug("Not reading config for {0}".format(options.command))
         config = {}
     else:
         raise jenkins_jobs.errors.JenkinsJobsException(
             "A valid configuration file is required when not run as a test")
 
     logger.debug("Config: {0}".format(config))
-    builder = jenkins_jobs.builder.Builder(config.get('jenkins', 'url'),
-                                           config.get('jenkins', 'user'),
-                                           config.get('jenkins', 'password'),
-                                           config)
+    for signame in ('SIGTERM', 'SIGHUP'):
+        if hasattr(signal, signame):
+            signal.signal(getattr(signal, signame), exit_on_signal)
+    masters = jenkins_jobs.builder.get_masters(config)
+    if options.masters:
+        sections = dict(masters)
+        for name in options.masters:
+            if name not in sections:
+                raise jenkins_jobs.errors.JenkinsJobsException(
+                    "Unknown Jenkins master '{0}', expected one of: "
+                    "{1}".format(name, ', '.join(sorted(sections))))
+        masters = [(name, sections[name]) for name in options.masters]
+    if not masters:
+        raise jenkins_jobs.errors.JenkinsJobsException(
+            "No Jenkins master is configured")
+    if len(masters) > 1 and options.command != 'update':
+        if options.masters:
+            raise jenkins_jobs.errors.JenkinsJobsException(
+                "Only update can use several masters at once")
+        masters = masters[:1]
+    builders = []
+    for name, section in masters:
+        builders.append((name, jenkins_jobs.builder.Builder(
+            config.get(section, 'url'),
+            jenkins_jobs.builder.get_master_option(config, section, 'user'),
+            jenkins_jobs.builder.get_master_option(config, section,
+                                                   'password'),
+            config, section)))
+    builder = builders[0][1]
 
     if options.command == 'delete':
-        for job in options.name:
-            logger.info("Deleting job {0}".format(job))
-            builder.delete_job(job)
+        if builder.delete_jobs(options.name, options.regex, options.workers,
+                               options.dry_run):
+            sys.exit(1)
     elif options.command == 'delete-all':
-        confirm('Sure you want to delete *ALL* jobs from Jenkins server?\n'
-                '(including those not managed by Jenkins Job Builder)')
-        logger.info("Deleting all jobs")
-        builder.delete_all_jobs()
+        if not options.dry_run:
+            confirm('Sure you want to delete *ALL* jobs from Jenkins '
+                    'server?\n(including those not managed by Jenkins Job '
+                    'Builder)')
+            logger.info("Deleting all jobs")
+        if builder.delete_jobs(workers=options.workers,
+                               dry_run=options.dry_run):
+            sys.exit(1)
     elif options.command == 'update':
+        if options.verify_sample:
+            for name, master in builders:
+                master.verify_cache(options.verify_sample,
+                                    options.fetch_workers)
         logger.info("Updating jobs in {0} ({1})".format(
             options.path, options.names))
-        builder.update_job(options.path, options.names)
+        if len(builders) > 1:
+            results = jenkins_jobs.builder.update_masters(
+                builders, options.path, options.names,
+                options.upload_workers, options.max_rps, options.delete_old,
+                options.detect_renames, options.resume)
+            if not all(failed == [] for failed in results.itervalues()):
+                sys.exit(1)
+        elif builder.update_job(options.path, options.names,
+                                workers=options.upload_workers,
+                                max_rps=options.max_rps,
+                                delete_old=options.delete_old,
+                                detect_renames=options.detect_renames,
+                                resume=options.resume):
+            sys.exit(1)
+    elif options.command == 'plan':
+        logger.info("Planning the update of jobs in {0} ({1})".format(
+            options.path, options.names))
+        # A plan cut short must not be left behind to be applied
+        jenkins_jobs.files.write_file_atomically(
+            options.output, lambda output: builder.plan(
+                options.path, output, options.names, options.delete_old,
+                options.detect_renames, options.workers))
+    elif options.command == 'apply':
+        with open(options.plan, 'rb') as plan:
+            if builder.apply(plan, options.upload_workers, options.max_rps):
+                sys.exit(1)
+    elif options.command == 'diff':
+        if builder.diff(options.path, options.names, options.regex,
+                        options.workers, options.summary):
+            sys.exit(1)
+    elif options.command == 'drift':
+        report = builder.drift(options.path, options.workers,
+                               options.refresh_cache)
+        if options.json:
+            print json.dumps(report, indent=2, separators=(',', ': '),
+                             sort_keys=True)
+        else:
+            for kind in ('server', 'both', 'missing', 'yaml', 'failed'):
+                for name in report[kind]:
+                    print '{0:<8} {1}'.format(kind, name)
+        if report['server'] or report['both'] or report['missing'] or \
+                report['failed']:
+            sys.exit(1)
+    elif options.command == 'cache':
+        if options.cache_command == 'migrate':
+            builder.migrate_cache()
+        elif options.cache_command == 'seed':
+            if builder.seed_cache(options.workers):
+                sys.exit(1)
+    elif options.command == 'provision':
+        builder.provision(options.path, options.jenkins_home, options.names,
+                          options.reload)
     elif options.command == 'test':
         builder.update_job(options.path, options.name,
                            output_dir=options.output_dir)
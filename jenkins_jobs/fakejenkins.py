@@ -0,0 +1,279 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# A local stand-in for a Jenkins server, for tests and benchmarks
+
+import argparse
+import base64
+import BaseHTTPServer
+import collections
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+from jenkins_jobs.builder import SCRIPT_RESULT
+
+CRUMB_FIELD = 'Jenkins-Crumb'
+
+# A job in the script jenkins-jobs sends to update jobs in batches
+SCRIPT_JOB_RE = re.compile(
+    r"^\s*\['([A-Za-z0-9+/=]*)', '([A-Za-z0-9+/=]*)'\],$", re.MULTILINE)
+
+
+def empty_config(description=''):
+    return ("<?xml version='1.0' encoding='UTF-8'?>\n<project>\n"
+            "  <description>{0}</description>\n</project>".format(description))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go rather than a write per header, which
+    # stalls kept-alive connections on delayed ACKs
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body='', content_type='text/plain',
+              headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        url = urlparse.urlsplit(self.path)
+        path = [urllib.unquote(part)
+                for part in url.path.strip('/').split('/') if part]
+        query = dict((key, values[-1]) for key, values
+                     in urlparse.parse_qs(url.query).iteritems())
+        body = ''
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length',
+                                                        0)))
+        status, data, headers = self.server.jenkins.handle(
+            method, path, query, body, self.headers)
+        content_type = 'text/plain'
+        if data.startswith('<'):
+            content_type = 'application/xml'
+        elif data.startswith('{'):
+            content_type = 'application/json'
+        self._send(status, data, content_type, headers)
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeJenkins(object):
+    """An in-memory Jenkins server answering the requests jenkins-jobs
+    and python-jenkins make: the job list, job info, ``config.xml``,
+    ``createItem``, ``doRename``, ``doDelete`` and the CSRF crumb
+    issuer.  The script console only runs the script jenkins-jobs uses
+    to update jobs in batches, and is refused unless script_console is
+    true.
+
+    The jobs are kept in :attr:`jobs`, a dict of job names to their
+    configuration, which may be filled before starting the server and
+    inspected afterwards.  Every request is counted in :attr:`requests`
+    by method and endpoint, such as ``('POST', 'createItem')`` or, for
+    any job, ``('GET', 'job/config.xml')``.
+
+    To see how clients cope with a slow or failing server, each request
+    can be delayed by latency seconds, and fail with error_status for a
+    fraction error_rate of the requests, for the next requests to the
+    endpoints counted in :attr:`failing`, or always for the jobs listed
+    in :attr:`broken`, including when they are updated by a script.
+    With crumbs enabled, POST requests without the crumb are refused as
+    Jenkins does with CSRF protection.
+
+    Use :meth:`start` to serve in a background thread on a free port of
+    the loopback interface; :attr:`url` is then the URL of the server.
+    """
+
+    def __init__(self, jobs=None, latency=0, error_rate=0,
+                 error_status=503, crumbs=True, script_console=True):
+        self.jobs = dict(jobs or {})
+        self.script_console = script_console
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.broken = set()
+        self.failing = collections.Counter()
+        self.crumb = crumbs and '{0:032x}'.format(random.getrandbits(128))
+        self.requests = collections.Counter()
+        self.reloads = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def start(self, port=0):
+        self.server = Server(('127.0.0.1', port), Handler)
+        self.server.jenkins = self
+        self.url = 'http://127.0.0.1:{0}/'.format(
+            self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, query, body, headers):
+        """Answer a request and return its status, body and any extra
+        response headers."""
+        if path[:1] == ['job'] and len(path) > 2:
+            name, endpoint = path[1], '/'.join(['job'] + path[2:])
+        else:
+            name, endpoint = None, '/'.join(path)
+        with self.lock:
+            self.requests[method, endpoint] += 1
+            failing = self.failing[method, endpoint] > 0
+            if failing:
+                self.failing[method, endpoint] -= 1
+        if self.latency:
+            time.sleep(self.latency)
+        if (failing or random.random() < self.error_rate or
+                name in self.broken or query.get('name') in self.broken):
+            return self.error_status, '', {}
+        if (method == 'POST' and self.crumb and
+                headers.get(CRUMB_FIELD) != self.crumb):
+            return 403, 'No valid crumb was included in the request', {}
+        handler = getattr(self, '_{0}_{1}'.format(
+            method, endpoint.replace('/', '_').replace('.', '_')), None)
+        if handler is None:
+            return 404, '', {}
+        with self.lock:
+            if name is None:
+                return handler(query, body)
+            if name not in self.jobs:
+                return 404, '', {}
+            return handler(name, query, body)
+
+    def _GET_api_json(self, query, body):
+        jobs = [{'name': name, 'url': '{0}job/{1}/'.format(
+            self.url, urllib.quote(name)), 'color': 'blue'}
+            for name in sorted(self.jobs)]
+        return 200, json.dumps({'jobs': jobs}), {}
+
+    def _GET_crumbIssuer_api_json(self, query, body):
+        if not self.crumb:
+            return 404, '', {}
+        return 200, json.dumps({'crumbRequestField': CRUMB_FIELD,
+                                'crumb': self.crumb}), {}
+
+    def _POST_createItem(self, query, body):
+        name = query.get('name')
+        if not name:
+            return 400, 'No job name given', {}
+        if name in self.jobs:
+            return 400, 'A job already exists with the name ' + name, {}
+        self.jobs[name] = body
+        return 200, '', {}
+
+    def _POST_scriptText(self, query, body):
+        if not self.script_console:
+            return 403, 'Access denied', {}
+        script = urlparse.parse_qs(body).get('script', [''])[0]
+        output = []
+        for encoded_name, encoded_xml in SCRIPT_JOB_RE.findall(script):
+            name = base64.b64decode(encoded_name).decode('utf-8')
+            if name in self.broken:
+                output.append('{0} failed {1} {2}'.format(
+                    SCRIPT_RESULT, encoded_name,
+                    base64.b64encode('java.io.IOException: broken')))
+                continue
+            outcome = name in self.jobs and 'updated' or 'created'
+            self.jobs[name] = base64.b64decode(encoded_xml)
+            output.append('{0} {1} {2}'.format(SCRIPT_RESULT, outcome,
+                                               encoded_name))
+        return 200, ''.join(line + '\n' for line in output), {}
+
+    def _POST_reload(self, query, body):
+        self.reloads += 1
+        return 302, '', {'Location': self.url}
+
+    def _GET_job_api_json(self, name, query, body):
+        return 200, json.dumps({'name': name}), {}
+
+    def _GET_job_config_xml(self, name, query, body):
+        return 200, self.jobs[name], {}
+
+    def _POST_job_config_xml(self, name, query, body):
+        self.jobs[name] = body
+        return 200, '', {}
+
+    def _POST_job_doRename(self, name, query, body):
+        new_name = query.get('newName')
+        if not new_name or new_name in self.jobs:
+            return 400, 'Cannot rename to {0}'.format(new_name), {}
+        self.jobs[new_name] = self.jobs.pop(name)
+        return 302, '', {'Location': '{0}job/{1}/'.format(
+            self.url, urllib.quote(new_name))}
+
+    def _POST_job_doDelete(self, name, query, body):
+        del self.jobs[name]
+        return 302, '', {'Location': self.url}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for a Jenkins server.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='number of jobs to start with')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests to fail with a 503')
+    parser.add_argument('--no-crumbs', dest='crumbs', action='store_false',
+                        help='do not require a crumb for POST requests')
+    options = parser.parse_args()
+    jobs = dict(('job-{0}'.format(i), empty_config('job {0}'.format(i)))
+                for i in xrange(options.jobs))
+    jenkins = FakeJenkins(jobs, options.latency, options.error_rate,
+                          crumbs=options.crumbs).start(options.port)
+    print 'Serving {0} jobs on {1}'.format(len(jenkins.jobs), jenkins.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        jenkins.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Writing files which other processes may be reading, or which belong to
+# another user such as those of JENKINS_HOME
+
+import errno
+import os
+import stat
+import tempfile
+
+# The umask can only be read by changing it, which is best done before
+# any thread creates files.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def give_to_owner(chown, target, owner):
+    """Call chown(target, uid, gid) to give target to owner, the stat
+       result of another file, as root does to write into JENKINS_HOME.
+       Other users may not give files away, their files are theirs."""
+    if (owner.st_uid, owner.st_gid) == (os.geteuid(), os.getegid()):
+        return
+    try:
+        chown(target, owner.st_uid, owner.st_gid)
+    except OSError, e:
+        if e.errno != errno.EPERM:
+            raise
+
+
+def write_file_atomically(filename, write):
+    """Call write() with a temporary file object in the directory of
+       filename, then rename the temporary file over filename.  Readers
+       see either the old or the new contents, never a partial file.
+       The file keeps its mode and owner; a new file gets the usual mode
+       and the owner of its directory."""
+    directory = os.path.dirname(filename)
+    try:
+        owner = os.stat(filename)
+        mode = stat.S_IMODE(owner.st_mode)
+    except OSError:
+        owner = os.stat(directory or os.curdir)
+        mode = 0666 & ~UMASK
+    fd, tmpname = tempfile.mkstemp(dir=directory,
+                                   prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            give_to_owner(os.fchown, fd, owner)
+            os.fchmod(fd, mode)
+            write(tmpfile)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
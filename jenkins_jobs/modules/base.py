@@ -64,6 +64,12 @@ class Base(object):
         Element objects and add them to the xml_parent.  The YAML data
         structure must not be modified.
 
+        Existing elements must not be changed other than by appending
+        children to them, so that the output of each module can be
+        cached separately (see the ``section-cache`` option).  Use
+        ``parser.getSection(xml_parent, tag)`` to get a top-level section
+        such as ``properties`` which other modules may also add to.
+
         :arg YAMLParser parser: the global YAML Parser
         :arg Element xml_parent: the parent XML element
         :arg dict data: the YAML data structure
@@ -89,9 +89,7 @@ class HipChat(jenkins_jobs.modules.base.Base):
                 "Missing hipchat 'room' specifier")
         self._load_global_data()
 
-        properties = xml_parent.find('properties')
-        if properties is None:
-            properties = XML.SubElement(xml_parent, 'properties')
+        properties = parser.getSection(xml_parent, 'properties')
         pdefhip = XML.SubElement(properties,
                                  'jenkins.plugins.hipchat.'
                                  'HipChatNotifier_-HipChatJobProperty')
@@ -99,9 +97,7 @@ class HipChat(jenkins_jobs.modules.base.Base):
         XML.SubElement(pdefhip, 'startNotification').text = str(
             hipchat.get('start-notify', 'false')).lower()
 
-        publishers = xml_parent.find('publishers')
-        if publishers is None:
-            publishers = XML.SubElement(xml_parent, 'publishers')
+        publishers = parser.getSection(xml_parent, 'publishers')
         hippub = XML.SubElement(publishers,
                                 'jenkins.plugins.hipchat.HipChatNotifier')
         XML.SubElement(hippub, 'jenkinsUrl').text = self.jenkinsUrl
@@ -62,9 +62,7 @@ class Notifications(jenkins_jobs.modules.base.Base):
     sequence = 22
 
     def gen_xml(self, parser, xml_parent, data):
-        properties = xml_parent.find('properties')
-        if properties is None:
-            properties = XML.SubElement(xml_parent, 'properties')
+        properties = parser.getSection(xml_parent, 'properties')
 
         notifications = data.get('notifications', [])
         if notifications:
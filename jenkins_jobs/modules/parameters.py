@@ -245,9 +245,7 @@ class Parameters(jenkins_jobs.modules.base.Base):
     sequence = 21
 
     def gen_xml(self, parser, xml_parent, data):
-        properties = xml_parent.find('properties')
-        if properties is None:
-            properties = XML.SubElement(xml_parent, 'properties')
+        properties = parser.getSection(xml_parent, 'properties')
 
         parameters = data.get('parameters', [])
         if parameters:
@@ -306,9 +306,7 @@ class Properties(jenkins_jobs.modules.base.Base):
     sequence = 20
 
     def gen_xml(self, parser, xml_parent, data):
-        properties = xml_parent.find('properties')
-        if properties is None:
-            properties = XML.SubElement(xml_parent, 'properties')
+        properties = parser.getSection(xml_parent, 'properties')
 
         for prop in data.get('properties', []):
             self._dispatch('property', 'properties',
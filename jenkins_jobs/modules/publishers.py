@@ -1219,7 +1219,7 @@ class Publishers(jenkins_jobs.modules.base.Base):
     sequence = 70
 
     def gen_xml(self, parser, xml_parent, data):
-        publishers = XML.SubElement(xml_parent, 'publishers')
+        publishers = parser.getSection(xml_parent, 'publishers')
 
         for action in data.get('publishers', []):
             self._dispatch('publisher', 'publishers',
@@ -0,0 +1,198 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Run calls to a Jenkins server concurrently, without overloading it
+
+import logging
+import Queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Tells a worker thread there is nothing left to do
+_DONE = object()
+
+# Queue.get() cannot be interrupted with Ctrl-C unless it has a timeout
+_FOREVER = 60 * 60 * 24
+
+
+def run_in_parallel(func, items, workers):
+    """Call func(item) for every item using a pool of worker threads.
+
+    Yields an ``(item, result, error)`` tuple for each call as it
+    completes, in no particular order; error is the exception raised by
+    the call, if any, in which case result is None.  Items are taken
+    from the iterable only as workers become free, so large or lazily
+    generated sequences are never held in memory at once.  With one
+    worker or fewer, the calls are made in order in the calling thread.
+    """
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception, e:
+                yield item, None, e
+        return
+
+    tasks = Queue.Queue(workers * 2)
+    results = Queue.Queue()
+    feed_errors = []
+
+    def feed():
+        try:
+            for item in items:
+                tasks.put(item)
+        except Exception, e:
+            feed_errors.append(e)
+        for i in xrange(workers):
+            tasks.put(_DONE)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _DONE:
+                results.put(_DONE)
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception, e:
+                results.put((item, None, e))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for i in xrange(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = workers
+    while running:
+        result = results.get(True, _FOREVER)
+        if result is _DONE:
+            running -= 1
+        else:
+            yield result
+    if feed_errors:
+        raise feed_errors[0]
+
+
+class Scheduler(object):
+    """Adapt the number of calls made at once to how the server copes.
+
+    Calls made through :meth:`call` take one of :attr:`limit` slots,
+    which starts at one and grows by one each time as many calls as
+    there are slots have succeeded, up to workers.  It is halved when a
+    call fails with a transient error, or cut by a quarter when a call
+    takes much longer than the fastest seen so far, which shows the
+    server is queueing requests; at most once for each round of calls.
+    Calls which fail with a transient error, as told by the transient
+    function, are retried after a random delay which doubles with each
+    attempt.  With max_rps, calls are also spaced out so that no more
+    than max_rps are started each second.
+
+    Used with :func:`run_in_parallel` and the same number of workers,
+    this gives as much throughput as the server handles well without
+    making it slow for everyone else.
+    """
+
+    #: Number of times a call failing with a transient error is retried
+    retries = 3
+
+    #: Seconds to wait, at most, before the first retry
+    backoff = 1.0
+
+    #: Seconds to wait, at most, before any retry
+    max_backoff = 30.0
+
+    #: How many times slower than the fastest call a call may be before
+    #: the server is taken to be overloaded
+    slowdown = 4.0
+
+    #: Calls faster than this are never taken as a sign of overload
+    min_latency = 0.1
+
+    def __init__(self, workers, max_rps=None, transient=None):
+        self.workers = max(workers, 1)
+        self.max_rps = max_rps
+        self.transient = transient or (lambda error: False)
+        self.limit = 1.0
+        self.active = 0
+        self.condition = threading.Condition()
+        self.fastest = None
+        self.calls = 0
+        self.last_decrease = 0
+        self.retried = 0
+        self.next_start = time.time()
+
+    def _acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait(_FOREVER)
+            self.active += 1
+        if self.max_rps:
+            with self.condition:
+                now = time.time()
+                start = max(now, self.next_start)
+                self.next_start = start + 1.0 / self.max_rps
+            if start > now:
+                time.sleep(start - now)
+
+    def _release(self, latency=None, failed=False):
+        with self.condition:
+            self.active -= 1
+            self.calls += 1
+            if latency is not None:
+                if self.fastest is None or latency < self.fastest:
+                    self.fastest = latency
+                overloaded = (latency > self.min_latency and
+                              latency > self.fastest * self.slowdown)
+            else:
+                overloaded = False
+            if failed or overloaded:
+                # Only react once to the calls which were already
+                # running when the server got overloaded
+                if self.calls - self.last_decrease > self.limit:
+                    factor = 0.5 if failed else 0.75
+                    self.limit = max(1.0, self.limit * factor)
+                    self.last_decrease = self.calls
+                    logger.debug("Reducing concurrency to {0}".format(
+                        int(self.limit)))
+            elif latency is not None and self.limit < self.workers:
+                self.limit = min(self.workers, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def call(self, func, *args):
+        """Call func(*args) when a slot is free, retrying it if it fails
+        with a transient error, and return its result."""
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.time()
+            try:
+                result = func(*args)
+            except Exception, e:
+                transient = self.transient(e)
+                self._release(failed=transient)
+                if not transient or attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff,
+                                              self.backoff * 2 ** attempt))
+                logger.warning("Retrying in {0:.1f}s after error: "
+                               "{1}".format(delay, e))
+                with self.condition:
+                    self.retried += 1
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._release(time.time() - start)
+            return result
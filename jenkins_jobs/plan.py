@@ -0,0 +1,293 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# The changes an update makes to a Jenkins server, as written by
+# "jenkins-jobs plan" and read by "jenkins-jobs apply"
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.files import write_file_atomically
+
+MAGIC = 'JJB-PLAN'
+VERSION = 1
+
+# Changes are applied in this order: renames, then uploads, then deletions
+PHASES = {
+    'rename': 0,
+    'create': 1,
+    'update': 1,
+    'keep': 1,
+    'delete': 2,
+}
+
+# Bytes of a plan file read at a time
+CHUNK_SIZE = 64 * 1024
+
+
+class Change(object):
+    """A change to make to a job.
+
+    action is one of:
+
+    * ``rename``: rename job name to new_name
+    * ``create`` or ``update``: upload the configuration xml of job name
+    * ``keep``: job name is up to date, only record it in the cache
+    * ``delete``: delete job name
+
+    The hash, fingerprint and source of uploaded and kept jobs are those
+    recorded in the cache once the change is made.  Kept jobs without a
+    hash were not generated, and only need to be marked as managed.
+    """
+
+    __slots__ = ('action', 'name', 'new_name', 'md5', 'fingerprint',
+                 'source', 'xml')
+
+    def __init__(self, action, name, new_name=None, md5=None,
+                 fingerprint=None, source=None, xml=None):
+        if action not in PHASES:
+            raise JenkinsJobsException("Unknown change '{0}'".format(action))
+        self.action = action
+        self.name = name
+        self.new_name = new_name
+        self.md5 = md5
+        self.fingerprint = fingerprint
+        self.source = source
+        self.xml = xml
+
+    @property
+    def phase(self):
+        return PHASES[self.action]
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__
+                    if getattr(self, field) is not None)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict((str(key), value) for key, value in data.iteritems())
+        for field in ('name', 'new_name', 'md5', 'fingerprint', 'source'):
+            if data.get(field) is not None:
+                # Job names are kept as the YAML parser would, the other
+                # fields are ASCII
+                try:
+                    data[field] = str(data[field])
+                except UnicodeEncodeError:
+                    pass
+        if data.get('xml') is not None:
+            data['xml'] = data['xml'].encode('utf-8')
+        return cls(**data)
+
+    def __repr__(self):
+        return '<Change {0} {1}>'.format(self.action, self.name)
+
+
+class PlanWriter(object):
+    """Write a plan to a file object: a line with the magic string and
+    format version, then a zlib stream of JSON records, one per line.
+    The first record is the header, a dict describing the plan; each
+    other one is a :class:`Change`, up to the trailer written by
+    :meth:`close`, which holds the number of changes of each action so
+    that a plan cut short can be told from a complete one.  Changes
+    must be written in the order of their phases.  :attr:`counts` counts
+    them by action."""
+
+    def __init__(self, fileobj, header):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(9)
+        self.counts = collections.Counter()
+        self.phase = 0
+        fileobj.write('{0} {1}\n'.format(MAGIC, VERSION))
+        self._write(header)
+
+    def _write(self, record):
+        self.fileobj.write(self.compressor.compress(
+            json.dumps(record, separators=(',', ':')) + '\n'))
+
+    def write(self, change):
+        if change.phase < self.phase:
+            raise JenkinsJobsException("Cannot {0} job {1} after the "
+                                       "changes of a later phase".format(
+                                           change.action, change.name))
+        self.phase = change.phase
+        self.counts[change.action] += 1
+        self._write(change.to_dict())
+
+    def close(self):
+        self._write({'end': self.counts})
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.flush()
+
+
+def _lines(fileobj):
+    decompressor = zlib.decompressobj()
+    pending = ''
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += decompressor.decompress(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if decompressor.unused_data:
+        raise JenkinsJobsException("The plan has data after its end")
+    # Python 2 does not tell when the end of the stream was read, but
+    # after it more data is left unused rather than decompressed.
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        pass
+    if probe.unused_data != '\0':
+        raise JenkinsJobsException("The plan is truncated")
+    pending += decompressor.flush()
+    if pending:
+        raise JenkinsJobsException("The plan is truncated")
+
+
+def _check_trailer(lines):
+    counts = collections.Counter()
+    for line in lines:
+        record = json.loads(line)
+        if 'end' not in record:
+            counts[record['action']] += 1
+        elif record['end'] != counts:
+            break
+        elif next(lines, None) is not None:
+            raise JenkinsJobsException("The plan has data after its end")
+        else:
+            return
+    raise JenkinsJobsException("The plan is truncated")
+
+
+def _changes(lines):
+    for line in lines:
+        record = json.loads(line)
+        if 'end' in record:
+            return
+        yield Change.from_dict(record)
+
+
+def read_plan(fileobj):
+    """Read a plan written by :class:`PlanWriter` and return its header
+    and an iterator over its changes, which are only read from the file
+    as they are needed.  The plan is checked to be complete first, so
+    fileobj must be seekable."""
+    first = fileobj.readline().split()
+    if len(first) != 2 or first[0] != MAGIC:
+        raise JenkinsJobsException("Not a jenkins-jobs plan")
+    if first[1] != str(VERSION):
+        raise JenkinsJobsException("Unsupported plan version {0}, "
+                                   "expected {1}".format(first[1], VERSION))
+    start = fileobj.tell()
+    lines = _lines(fileobj)
+    try:
+        header = json.loads(next(lines))
+    except StopIteration:
+        raise JenkinsJobsException("The plan is truncated")
+    _check_trailer(lines)
+    fileobj.seek(start)
+    lines = _lines(fileobj)
+    next(lines)
+    return header, _changes(lines)
+
+
+class Journal(object):
+    """The progress of an update of the jobs on a Jenkins server, kept
+    in the cache directory so that an interrupted update can be resumed.
+
+    The plan of the update is kept in :attr:`plan_filename`, and each
+    job change is recorded in a log as it is started and as it ends, one
+    line per event, so that the log survives the process dying at any
+    point.  Jobs which were started but did not end are in flight: their
+    change may or may not have been made.  The journal is removed once
+    the update is over.  It may be recorded to from several threads.
+    """
+
+    def __init__(self, directory, url):
+        key = hashlib.md5(url).hexdigest()
+        self.plan_filename = os.path.join(
+            directory, 'jenkins_jobs_update_{0}.plan'.format(key))
+        self.log_filename = os.path.join(
+            directory, 'jenkins_jobs_update_{0}.log'.format(key))
+        self.log = None
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.plan_filename)
+
+    def create(self, write):
+        """Start a new journal, calling write() with the file object to
+        write the plan to.  The plan only replaces that of any previous
+        update once it is complete."""
+        self.remove()
+        write_file_atomically(self.plan_filename, write)
+
+    def read(self):
+        """Return the names of the jobs whose change was made, and of
+        those which are in flight."""
+        done = set()
+        started = set()
+        try:
+            log = open(self.log_filename, 'r')
+        except IOError:
+            return done, started
+        with log:
+            for line in log:
+                try:
+                    event, name = line.split(' ', 1)
+                    name = json.loads(name)
+                except ValueError:
+                    # The last line may have been cut short
+                    continue
+                if not isinstance(name, str):
+                    try:
+                        name = str(name)
+                    except UnicodeEncodeError:
+                        pass
+                if event == 'started':
+                    started.add(name)
+                    continue
+                started.discard(name)
+                if event == 'done':
+                    done.add(name)
+        return done, started
+
+    def open(self):
+        """Open the journal to record events, and return its plan."""
+        self.log = open(self.log_filename, 'a')
+        return open(self.plan_filename, 'rb')
+
+    def record(self, event, name):
+        """Record that the change of job name was started, done or has
+        failed."""
+        with self.lock:
+            self.log.write('{0} {1}\n'.format(event, json.dumps(name)))
+            self.log.flush()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def remove(self):
+        self.close()
+        for filename in (self.plan_filename, self.log_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
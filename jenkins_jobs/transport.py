@@ -0,0 +1,303 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Persistent HTTP connections to a Jenkins server
+
+import errno
+import httplib
+import json
+import logging
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+
+import jenkins
+
+logger = logging.getLogger(__name__)
+
+CRUMB_ISSUER = 'crumbIssuer/api/json'
+
+# Redirects followed for a GET before giving up
+MAX_REDIRECTS = 5
+
+# Responses of a busy or restarting server, worth trying again later
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+# Responses which show the request was turned away before it was
+# processed, so that any request may be made again
+REFUSED_STATUSES = (429, 503)
+
+# Requests which have the same effect whether they are made once or twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class HTTPError(jenkins.JenkinsException):
+    """An error response from Jenkins.  The status is kept in code, so
+    that callers can tell transient errors from permanent ones."""
+
+    def __init__(self, code, method, url):
+        jenkins.JenkinsException.__init__(
+            self, 'Error in request: {0} {1} returned {2}'.format(
+                method, url, code))
+        self.code = code
+        self.method = method
+
+
+class UncertainRequestError(jenkins.JenkinsException):
+    """A request which is not idempotent failed after it was sent, so
+    Jenkins may or may not have processed it.  It is not made again."""
+
+    def __init__(self, method, url, error):
+        jenkins.JenkinsException.__init__(
+            self, 'Error in request: {0} {1} failed, it may have been '
+            'processed: {2}'.format(method, url, error))
+        self.error = error
+
+
+def is_transient(error):
+    """Return whether a request which failed with error may succeed if
+    it is made again later.  Requests which are not idempotent are only
+    made again if they were turned away or never reached Jenkins."""
+    if isinstance(error, HTTPError):
+        if error.method not in IDEMPOTENT_METHODS:
+            return error.code in REFUSED_STATUSES
+        return error.code in TRANSIENT_STATUSES
+    return isinstance(error, (httplib.HTTPException, socket.error))
+
+
+def closed_unanswered(error):
+    """Return whether error means the server closed the connection
+    without sending any of its response, as it does with connections
+    which were idle too long."""
+    if isinstance(error, httplib.BadStatusLine):
+        return (error.line in ('', "''") or
+                error.line.startswith('No status line'))
+    return (isinstance(error, socket.error) and
+            error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP or HTTPS connections to a single server.
+
+    Up to size idle connections are kept open and reused, so most
+    requests avoid a TCP connection and TLS handshake.  Any number of
+    threads may make requests at once; connections beyond size are
+    closed once their request is done.  A size of 0 disables reuse.
+    """
+
+    def __init__(self, url, size=8, timeout=None):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def _connect(self):
+        if self.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        self.created += 1
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._connect(), False
+
+    def _put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def handles(self, url):
+        """Return whether url is on the server of this pool."""
+        parts = urlparse.urlsplit(url)
+        return parts.scheme == self.scheme and parts.netloc == self.netloc
+
+    def request(self, method, url, body=None, headers={}):
+        """Make a request and return the response status, headers and
+        body.  A request which fails on a reused connection is retried
+        once on a new one, as the server may have closed it while it was
+        idle.  Unless the request is idempotent, it is only retried if
+        it could not be sent, or the server closed the connection before
+        answering; otherwise it may already have been processed, and
+        :class:`UncertainRequestError` is raised."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        connection, reused = self._get()
+        while True:
+            sent = answered = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                answered = True
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if method not in IDEMPOTENT_METHODS and sent and (
+                        answered or not closed_unanswered(e)):
+                    raise UncertainRequestError(method, url, e)
+                if not reused:
+                    raise
+                connection, reused = self._connect(), False
+                continue
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(connection)
+        return response.status, dict(response.getheaders()), data
+
+
+class PooledJenkins(jenkins.Jenkins):
+    """A python-jenkins client whose requests all go through a
+    :class:`ConnectionPool`.
+
+    Every python-jenkins call ends up in :meth:`jenkins_open`, which is
+    replaced here.  It also adds the CSRF protection crumb to POST
+    requests; the crumb is fetched once and reused.  As with
+    python-jenkins, a missing resource gives None; other error responses
+    raise :class:`HTTPError`.  When the environment sets a proxy for the
+    server, requests are left to python-jenkins, which goes through it.
+
+    Unlike python-jenkins, :meth:`create_job`, :meth:`reconfig_job`,
+    :meth:`rename_job` and :meth:`delete_job` make a single request
+    each, without checking whether the job exists before and after;
+    callers which need to know keep track of the jobs themselves.
+    """
+
+    def __init__(self, url, username=None, password=None, pool_size=8,
+                 timeout=None):
+        jenkins.Jenkins.__init__(self, url, username, password)
+        self.pool = ConnectionPool(self.server, pool_size, timeout)
+        proxies = urllib.getproxies()
+        self.proxied = (self.pool.scheme in proxies and
+                        not urllib.proxy_bypass(self.pool.netloc))
+        if self.proxied:
+            logger.debug("Using the proxy {0} for {1}".format(
+                proxies[self.pool.scheme], self.server))
+        self.crumb = None
+        self.crumb_lock = threading.Lock()
+
+    def _headers(self, headers):
+        headers = dict(headers)
+        if self.auth:
+            headers['Authorization'] = self.auth
+        return headers
+
+    def get_crumb(self):
+        """Return the crumb header to send with POST requests, as a dict
+        which is empty if Jenkins does not use CSRF protection."""
+        with self.crumb_lock:
+            if self.crumb is None:
+                url = self.server + CRUMB_ISSUER
+                status, headers, data = self.pool.request(
+                    'GET', url, headers=self._headers({}))
+                if status == 200:
+                    crumb = json.loads(data)
+                    self.crumb = {crumb['crumbRequestField']: crumb['crumb']}
+                elif status == 404:
+                    self.crumb = {}
+                else:
+                    raise HTTPError(status, 'GET', url)
+            return self.crumb
+
+    def jenkins_open(self, req, add_crumb=True):
+        url = req.get_full_url()
+        if self.proxied or not self.pool.handles(url):
+            return jenkins.Jenkins.jenkins_open(self, req)
+        method = req.get_method()
+        body = req.get_data()
+        headers = self._headers(req.header_items())
+        crumb = {}
+        if method == 'POST' and add_crumb:
+            crumb = self.get_crumb()
+            headers.update(crumb)
+        for redirect in xrange(MAX_REDIRECTS):
+            status, response_headers, data = self.pool.request(
+                method, url, body, headers)
+            if status == 403 and crumb:
+                # The crumb may have expired with the session; without
+                # a crumb issuer, the request was refused for good.
+                with self.crumb_lock:
+                    self.crumb = None
+                headers.update(self.get_crumb())
+                status, response_headers, data = self.pool.request(
+                    method, url, body, headers)
+            if status in (301, 302, 303, 307) and method == 'GET':
+                location = response_headers.get('location')
+                if location and self.pool.handles(
+                        urlparse.urljoin(url, location)):
+                    url = urlparse.urljoin(url, location)
+                    continue
+            break
+        if status == 404:
+            return None
+        if status >= 400:
+            raise HTTPError(status, method, url)
+        if 300 <= status < 400:
+            # Jenkins answers successful POSTs, such as deletions, with
+            # a redirect to the resulting page, which is not needed.
+            return ''
+        return data
+
+    def run_script(self, script):
+        """Run a Groovy script in the script console and return what it
+        printed."""
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        return self.jenkins_open(urllib2.Request(
+            self.server + 'scriptText', urllib.urlencode({'script': script}),
+            headers))
+
+    def _post_job(self, url, config_xml=''):
+        headers = {'Content-Type': 'text/xml'}
+        return self.jenkins_open(urllib2.Request(self.server + url,
+                                                 config_xml, headers))
+
+    def create_job(self, name, config_xml):
+        self._post_job('createItem?name=' + urllib.quote(name), config_xml)
+
+    def reconfig_job(self, name, config_xml):
+        if self._post_job(jenkins.CONFIG_JOB % {'name': urllib.quote(name)},
+                          config_xml) is None:
+            raise jenkins.JenkinsException('job[%s] does not exist' % name)
+
+    def rename_job(self, name, new_name):
+        if self._post_job(jenkins.RENAME_JOB % {
+                'name': urllib.quote(name),
+                'new_name': urllib.quote(new_name)}) is None:
+            raise jenkins.JenkinsException('job[%s] does not exist' % name)
+
+    def delete_job(self, name):
+        if self._post_job(jenkins.DELETE_JOB %
+                          {'name': urllib.quote(name)}) is None:
+            raise jenkins.JenkinsException('job[%s] does not exist' % name)
@@ -0,0 +1,404 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Updates of a stand-in Jenkins server by the Builder
+
+import ConfigParser
+import cPickle
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from jenkins_jobs.builder import Builder, canonical_xml, update_masters
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.fakejenkins import FakeJenkins, empty_config
+from jenkins_jobs.parallel import Scheduler
+
+JOBS = """
+- job-template:
+    name: '{name}-{python}'
+    description: 'Tests of {name} on {python}'
+- project:
+    name: alpha
+    python:
+      - py26
+      - py27
+    jobs:
+      - '{name}-{python}'
+- job:
+    name: plain-job
+    description: '{description}'
+"""
+
+
+class BuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='jenkins_jobs_test')
+        self.xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmpdir, 'cache')
+        self.jenkins = FakeJenkins().start()
+        self.write_jobs()
+        # Retries need not wait long
+        self.backoff = Scheduler.backoff
+        Scheduler.backoff = 0.01
+
+    def tearDown(self):
+        Scheduler.backoff = self.backoff
+        self.jenkins.stop()
+        if self.xdg_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.xdg_cache_home
+        shutil.rmtree(self.tmpdir)
+
+    def write_jobs(self, description='A job'):
+        self.path = os.path.join(self.tmpdir, 'jobs.yaml')
+        with open(self.path, 'w') as jobs:
+            jobs.write(JOBS.replace('{description}', description))
+
+    def builder(self, url=None, cache_backend='yaml', jobs_root=None,
+                **options):
+        config = ConfigParser.ConfigParser()
+        config.add_section('jenkins')
+        for option, value in options.iteritems():
+            config.set('jenkins', option.replace('_', '-'), str(value))
+        config.add_section('job_builder')
+        config.set('job_builder', 'cache-backend', cache_backend)
+        if jobs_root:
+            config.set('job_builder', 'jobs-root', jobs_root)
+        return Builder(url or self.jenkins.url, 'user', 'password', config)
+
+    def cache_files(self):
+        return os.listdir(os.path.join(os.environ['XDG_CACHE_HOME'],
+                                       'jenkins_jobs'))
+
+    def printed(self, func, *args, **kwargs):
+        # Returns what func printed, and its result
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            result = func(*args, **kwargs)
+            return sys.stdout.getvalue(), result
+        finally:
+            sys.stdout = stdout
+
+    def posts(self):
+        return sum(count for (method, endpoint), count
+                   in self.jenkins.requests.iteritems() if method == 'POST')
+
+    def test_update(self):
+        self.assertFalse(self.builder().update_job(self.path))
+        self.assertEqual(sorted(self.jenkins.jobs),
+                         ['alpha-py26', 'alpha-py27', 'plain-job'])
+        self.assertEqual(self.jenkins.requests['POST', 'createItem'], 3)
+
+        self.jenkins.requests.clear()
+        self.write_jobs('Another job')
+        self.assertFalse(self.builder().update_job(self.path))
+        self.assertEqual(self.posts(), 1)
+        self.assertEqual(self.jenkins.requests['POST', 'job/config.xml'], 1)
+        self.assertIn('Another job', self.jenkins.jobs['plain-job'])
+
+        self.jenkins.requests.clear()
+        self.assertFalse(self.builder().update_job(self.path))
+        self.assertEqual(self.posts(), 0)
+
+    def test_update_retries_fetches(self):
+        self.builder().update_job(self.path)
+        shutil.rmtree(os.environ['XDG_CACHE_HOME'])
+        self.jenkins.requests.clear()
+        self.jenkins.failing['GET', 'api/json'] = 1
+        self.jenkins.failing['GET', 'job/config.xml'] = 2
+        self.assertFalse(self.builder().update_job(self.path, workers=2))
+        self.assertEqual(self.jenkins.requests['GET', 'api/json'], 2)
+        self.assertEqual(self.jenkins.requests['GET', 'job/config.xml'], 5)
+        self.assertEqual(self.posts(), 0)
+
+    def test_resume(self):
+        builder = self.builder()
+        builder.prepare_update(lambda: builder.generate(self.path,
+                                                        builder.cache))
+        # The update died once planned; the plan is finished, even
+        # though the definitions changed since
+        self.write_jobs('Another job')
+        self.assertFalse(self.builder().update_job(self.path, resume=True))
+        self.assertEqual(len(self.jenkins.jobs), 3)
+        self.assertIn('A job', self.jenkins.jobs['plain-job'])
+        self.assertEqual([name for name in self.cache_files()
+                          if name.endswith('.plan')], [])
+
+        self.jenkins.requests.clear()
+        self.assertFalse(self.builder().update_job(self.path, resume=True))
+        self.assertEqual(self.posts(), 1)
+        self.assertIn('Another job', self.jenkins.jobs['plain-job'])
+
+    def test_delete_old(self):
+        root = os.path.join(self.tmpdir, 'jobs')
+        os.mkdir(root)
+        shutil.move(self.path, root)
+        other = os.path.join(root, 'other.yaml')
+        with open(other, 'w') as jobs:
+            jobs.write("- job:\n    name: other-job\n")
+        self.jenkins.jobs['handmade'] = empty_config()
+        self.assertFalse(self.builder(jobs_root=root).update_job(root))
+        self.assertEqual(len(self.jenkins.jobs), 5)
+
+        # Jobs defined elsewhere are not taken for old jobs
+        self.assertRaises(JenkinsJobsException,
+                          self.builder(jobs_root=root).update_job, other,
+                          delete_old=True)
+        self.assertRaises(JenkinsJobsException,
+                          self.builder().update_job, root, delete_old=True)
+        self.assertRaises(JenkinsJobsException,
+                          self.builder(jobs_root=root).update_job, root,
+                          ['plain-job'], delete_old=True)
+        self.assertEqual(len(self.jenkins.jobs), 5)
+
+        os.unlink(other)
+        self.assertFalse(self.builder(jobs_root=root).update_job(
+            root, delete_old=True))
+        self.assertEqual(sorted(self.jenkins.jobs),
+                         ['alpha-py26', 'alpha-py27', 'handmade',
+                          'plain-job'])
+
+    def test_detect_renames(self):
+        root = os.path.join(self.tmpdir, 'jobs')
+        os.mkdir(root)
+        shutil.move(self.path, root)
+        path = os.path.join(root, 'jobs.yaml')
+        self.assertFalse(self.builder(jobs_root=root).update_job(root))
+        with open(path) as jobs:
+            renamed = jobs.read().replace('{name}-{python}',
+                                          '{name}-on-{python}')
+        with open(path, 'w') as jobs:
+            jobs.write(renamed)
+        self.jenkins.requests.clear()
+        self.assertFalse(self.builder(jobs_root=root).update_job(
+            root, delete_old=True, detect_renames=True))
+        self.assertEqual(sorted(self.jenkins.jobs),
+                         ['alpha-on-py26', 'alpha-on-py27', 'plain-job'])
+        self.assertEqual(self.jenkins.requests['POST', 'job/doRename'], 2)
+        self.assertEqual(self.posts(), 2)
+
+        # Nothing is left to change
+        self.jenkins.requests.clear()
+        self.assertFalse(self.builder(jobs_root=root).update_job(
+            root, delete_old=True, detect_renames=True))
+        self.assertEqual(self.posts(), 0)
+
+    def test_section_cache_pruned(self):
+        root = os.path.join(self.tmpdir, 'jobs')
+        os.mkdir(root)
+        shutil.move(self.path, root)
+        other = os.path.join(root, 'other.yaml')
+        with open(other, 'w') as jobs:
+            jobs.write("- job:\n    name: other-job\n")
+
+        def cached_jobs():
+            with open(os.path.join(os.environ['XDG_CACHE_HOME'],
+                                   'jenkins_jobs',
+                                   'jenkins_jobs_sections.pickle')) as f:
+                return sorted(cPickle.load(f))
+
+        def update(fn):
+            builder = self.builder(jobs_root=root)
+            builder.global_config.set('job_builder', 'section-cache', 'true')
+            self.assertFalse(builder.update_job(fn))
+
+        update(root)
+        self.assertEqual(len(cached_jobs()), 4)
+        os.unlink(other)
+        # Other jobs may be defined outside of a single file
+        update(os.path.join(root, 'jobs.yaml'))
+        self.assertEqual(len(cached_jobs()), 4)
+        # Unchanged jobs are kept, though they were not generated
+        update(root)
+        self.assertEqual(cached_jobs(),
+                         ['alpha-py26', 'alpha-py27', 'plain-job'])
+
+    def test_provision(self):
+        jobs_dir = os.path.join(self.tmpdir, 'home', 'jobs')
+        os.makedirs(os.path.join(jobs_dir, 'plain-job'))
+        filename = os.path.join(jobs_dir, 'plain-job', 'config.xml')
+        with open(filename, 'w') as config_file:
+            config_file.write(empty_config())
+        os.chmod(filename, 0640)
+        self.assertEqual(sorted(self.builder().provision(
+            self.path, os.path.dirname(jobs_dir))),
+            ['alpha-py26', 'alpha-py27', 'plain-job'])
+        self.assertEqual(os.stat(filename).st_mode & 0777, 0640)
+        self.assertEqual(self.builder().provision(
+            self.path, os.path.dirname(jobs_dir)), [])
+        self.assertEqual(self.posts(), 0)
+
+    @unittest.skipUnless(os.geteuid() == 0, 'only root gives files away')
+    def test_provision_owner(self):
+        jobs_dir = os.path.join(self.tmpdir, 'home', 'jobs')
+        os.makedirs(os.path.join(jobs_dir, 'plain-job'))
+        os.chown(jobs_dir, 1000, 1000)
+        filename = os.path.join(jobs_dir, 'plain-job', 'config.xml')
+        with open(filename, 'w') as config_file:
+            config_file.write(empty_config())
+        os.chown(filename, 1001, 1001)
+        self.builder().provision(self.path, os.path.dirname(jobs_dir))
+        stat = os.stat(filename)
+        self.assertEqual((stat.st_uid, stat.st_gid), (1001, 1001))
+        for name in ('alpha-py26', os.path.join('alpha-py26', 'config.xml')):
+            stat = os.stat(os.path.join(jobs_dir, name))
+            self.assertEqual((stat.st_uid, stat.st_gid), (1000, 1000))
+
+    def test_delete_patterns(self):
+        self.jenkins.jobs.update((name, empty_config()) for name in
+                                 ('alpha-py26', 'alpha-py27', 'beta-py27'))
+        builder = self.builder()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertFalse(builder.delete_jobs(['alpha-*'], dry_run=True))
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed.split(), ['alpha-py26', 'alpha-py27'])
+        self.assertEqual(len(self.jenkins.jobs), 3)
+        self.assertFalse(builder.delete_jobs(['.*-py27'], regex=True))
+        self.assertEqual(sorted(self.jenkins.jobs), ['alpha-py26'])
+
+    def test_seed(self):
+        self.builder().update_job(self.path)
+        shutil.rmtree(os.environ['XDG_CACHE_HOME'])
+        self.jenkins.requests.clear()
+        builder = self.builder()
+        self.assertFalse(builder.seed_cache(workers=2))
+        self.assertEqual(self.jenkins.requests['GET', 'job/config.xml'], 3)
+        self.assertFalse(builder.update_job(self.path))
+        self.assertEqual(self.jenkins.requests['GET', 'job/config.xml'], 3)
+        self.assertEqual(self.posts(), 0)
+
+    def test_verify(self):
+        self.jenkins.jobs['handmade'] = empty_config()
+        self.builder().seed_cache()
+        self.builder().update_job(self.path)
+        self.jenkins.jobs['plain-job'] = empty_config()
+        self.jenkins.requests.clear()
+        self.jenkins.failing['GET', 'job/config.xml'] = 1
+        builder = self.builder()
+        self.assertRaises(JenkinsJobsException, builder.verify_cache, -5)
+        # Only the managed jobs are checked
+        self.assertEqual(builder.verify_cache(100, workers=2), 1)
+        self.assertEqual(self.jenkins.requests['GET', 'job/config.xml'], 4)
+        self.assertFalse(builder.update_job(self.path))
+        self.assertEqual(self.posts(), 1)
+        self.assertEqual(self.jenkins.requests['POST', 'job/config.xml'], 1)
+
+    def test_diff(self):
+        self.builder().update_job(self.path)
+        # Formatting does not matter
+        self.jenkins.jobs['alpha-py26'] = canonical_xml(
+            self.jenkins.jobs['alpha-py26'])
+        del self.jenkins.jobs['alpha-py27']
+        self.write_jobs('Another job')
+        self.jenkins.failing['GET', 'job/config.xml'] = 1
+        printed, differ = self.printed(self.builder().diff, self.path,
+                                       workers=2, summary=True)
+        self.assertEqual(printed.splitlines(),
+                         ['new      alpha-py27',
+                          'changed  plain-job (+1 -1)'])
+        self.assertEqual(differ, ['alpha-py27', 'plain-job'])
+
+        printed, differ = self.printed(self.builder().diff, self.path,
+                                       ['plain-job'])
+        self.assertIn('-  <description>A job</description>', printed)
+        self.assertIn('+  <description>Another job</description>', printed)
+        self.assertEqual(differ, ['plain-job'])
+        self.assertEqual(self.posts(), 3)
+
+    def test_drift(self):
+        self.jenkins.jobs['handmade'] = empty_config()
+        self.builder().update_job(self.path)
+        self.jenkins.jobs['alpha-py26'] = empty_config()
+        self.jenkins.jobs['handmade'] = empty_config() + ' '
+        del self.jenkins.jobs['alpha-py27']
+        self.write_jobs('Another job')
+        self.jenkins.failing['GET', 'job/config.xml'] = 1
+        report = self.builder().drift(self.path, workers=2)
+        self.assertEqual(report, {'server': ['alpha-py26'],
+                                  'yaml': ['plain-job'], 'both': [],
+                                  'missing': ['alpha-py27'], 'failed': []})
+
+        # Refreshed, the cache makes the next update put the jobs back
+        self.builder().drift(self.path, refresh_cache=True)
+        self.assertFalse(self.builder().update_job(self.path))
+        self.assertEqual(sorted(self.jenkins.jobs),
+                         ['alpha-py26', 'alpha-py27', 'handmade',
+                          'plain-job'])
+        self.assertIn('Tests of alpha on py26',
+                      self.jenkins.jobs['alpha-py26'])
+        self.assertEqual(self.builder().drift(self.path),
+                         {'server': [], 'yaml': [], 'both': [],
+                          'missing': [], 'failed': []})
+
+    def test_script_batches(self):
+        self.assertFalse(self.builder(script_batch_size=2).update_job(
+            self.path))
+        self.assertEqual(len(self.jenkins.jobs), 3)
+        # A batch of a single job is uploaded as usual
+        self.assertEqual(self.jenkins.requests['POST', 'scriptText'], 1)
+        self.assertEqual(self.jenkins.requests['POST', 'createItem'], 1)
+
+    def test_script_batches_refused(self):
+        self.jenkins.script_console = False
+        self.assertFalse(self.builder(script_batch_size=2).update_job(
+            self.path, workers=2))
+        self.assertEqual(len(self.jenkins.jobs), 3)
+        self.assertEqual(self.jenkins.requests['POST', 'createItem'], 3)
+
+    def test_script_batches_missing(self):
+        with open(os.path.join(self.tmpdir, 'more.yaml'), 'w') as jobs:
+            jobs.write("- job:\n    name: job-a\n"
+                       "- job:\n    name: job-b\n")
+        with FakeJenkins(error_status=404) as jenkins:
+            jenkins.failing['POST', 'scriptText'] = 10
+            self.assertFalse(self.builder(
+                jenkins.url, script_batch_size=2).update_job(self.tmpdir))
+            self.assertEqual(len(jenkins.jobs), 5)
+            # Batching is given up after the first batch
+            self.assertEqual(jenkins.requests['POST', 'scriptText'], 1)
+            self.assertEqual(jenkins.requests['POST', 'createItem'], 5)
+
+    def test_update_masters(self):
+        with FakeJenkins() as standby:
+            builders = [
+                ('default', self.builder(cache_backend='sqlite')),
+                ('standby', self.builder(standby.url, 'sqlite'))]
+            self.assertEqual(update_masters(builders, self.path),
+                             {'default': [], 'standby': []})
+            self.assertEqual(standby.jobs, self.jenkins.jobs)
+
+    def test_update_masters_unreachable(self):
+        standby = FakeJenkins().start()
+        standby.stop()
+        builders = [('default', self.builder(cache_backend='sqlite')),
+                    ('standby', self.builder(standby.url, 'sqlite'))]
+        self.assertEqual(update_masters(builders, self.path),
+                         {'default': [], 'standby': None})
+        self.assertEqual(len(self.jenkins.jobs), 3)
+        # No update is left to resume on either master
+        self.assertEqual([name for name in self.cache_files()
+                          if name.endswith('.plan')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
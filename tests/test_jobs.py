@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Serialization of the generated jobs
+
+import unittest
+import xml.etree.ElementTree as XML
+
+from jenkins_jobs.builder import JobList, XmlJob, canonical_xml
+
+
+class CanonicalXmlTestCase(unittest.TestCase):
+
+    def test_formatting_ignored(self):
+        generated = ('<project><description>A job</description>'
+                     '<builders><hudson.tasks.Shell a="1" b="2">'
+                     '<command>make</command></hudson.tasks.Shell>'
+                     '</builders></project>')
+        saved = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+                 '<project>\n  <description>A job</description>\n'
+                 '  <builders>\n'
+                 '    <hudson.tasks.Shell b="2" a="1" plugin="shell@1.0">\n'
+                 '      <command>make</command>\n'
+                 '    </hudson.tasks.Shell>\n'
+                 '  </builders>\n</project>\n')
+        self.assertEqual(canonical_xml(saved), canonical_xml(generated))
+        self.assertEqual(canonical_xml(XML.fromstring(generated)),
+                         canonical_xml(generated))
+
+    def test_changes_kept(self):
+        self.assertNotEqual(
+            canonical_xml('<project><description>A job</description>'
+                          '</project>'),
+            canonical_xml('<project><description>A job </description>'
+                          '</project>'))
+        self.assertNotEqual(canonical_xml('<project><a/><b/></project>'),
+                            canonical_xml('<project><b/><a/></project>'))
+
+    def test_element_unchanged(self):
+        element = XML.fromstring('<project plugin="x"> <a/> </project>')
+        canonical_xml(element)
+        self.assertEqual(XML.tostring(element),
+                         '<project plugin="x"> <a /> </project>')
+
+    def test_unicode(self):
+        self.assertEqual(
+            canonical_xml(u'<project><description>\xe9</description>'
+                          u'</project>'),
+            '<project><description>\xc3\xa9</description></project>')
+
+
+class JobListTestCase(unittest.TestCase):
+
+    def job(self, name, description):
+        return XmlJob(XML.fromstring(
+            '<project><description>{0}</description></project>'.format(
+                description)), name)
+
+    def fill(self, jobs):
+        for name, description in [('c', 1), ('a', 1), ('b', 1), ('a', 2),
+                                  ('d', 1), ('c', 2), ('e', 1)]:
+            jobs.append(self.job(name, description))
+        jobs.skip('d')
+
+    def contents(self, jobs):
+        return [(job.name, job.xml.findtext('description')) for job in jobs]
+
+    def test_spill(self):
+        in_memory = JobList()
+        self.fill(in_memory)
+        # Every other job goes to disk
+        spilled = JobList(budget=self.job('a', 1).size() + 1)
+        self.fill(spilled)
+        self.assertEqual(len(spilled.runs), 3)
+        self.assertEqual(len(spilled), 7)
+        self.assertEqual(self.contents(spilled), self.contents(in_memory))
+        self.assertEqual(self.contents(spilled),
+                         [('a', '1'), ('a', '2'), ('b', '1'), ('c', '1'),
+                          ('c', '2'), ('d', '1'), ('e', '1')])
+        self.assertEqual(self.contents(spilled.latest()),
+                         [('a', '2'), ('b', '1'), ('c', '2'), ('e', '1')])
+        # The jobs can be iterated over more than once
+        self.assertEqual(self.contents(spilled.latest()),
+                         self.contents(in_memory.latest()))
+
+    def test_skipped_before(self):
+        jobs = JobList(budget=0)
+        jobs.skip('a')
+        jobs.append(self.job('a', 1))
+        self.assertEqual(self.contents(jobs.latest()), [('a', '1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Writing and reading plans
+
+import StringIO
+import unittest
+
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.plan import Change, PlanWriter, read_plan
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        output = StringIO.StringIO()
+        writer = PlanWriter(output, {'url': 'http://jenkins/'})
+        writer.write(Change('rename', 'old', 'new'))
+        writer.write(Change('create', 'job', md5='0' * 32,
+                            xml='<project/>'))
+        writer.write(Change('delete', 'gone'))
+        writer.close()
+        self.plan = output.getvalue()
+
+    def read(self, plan):
+        header, changes = read_plan(StringIO.StringIO(plan))
+        return header, [change.to_dict() for change in changes]
+
+    def test_read(self):
+        self.assertEqual(self.read(self.plan), ({'url': 'http://jenkins/'}, [
+            {'action': 'rename', 'name': 'old', 'new_name': 'new'},
+            {'action': 'create', 'name': 'job', 'md5': '0' * 32,
+             'xml': '<project/>'},
+            {'action': 'delete', 'name': 'gone'}]))
+
+    def test_truncated(self):
+        # Cut anywhere, even between records, a plan is refused before
+        # any change is read
+        for size in xrange(len(self.plan)):
+            self.assertRaises(JenkinsJobsException, read_plan,
+                              StringIO.StringIO(self.plan[:size]))
+
+    def test_trailing_data(self):
+        self.assertRaises(JenkinsJobsException, read_plan,
+                          StringIO.StringIO(self.plan + self.plan))
+
+    def test_phases(self):
+        writer = PlanWriter(StringIO.StringIO(), {})
+        writer.write(Change('delete', 'gone'))
+        self.assertRaises(JenkinsJobsException, writer.write,
+                          Change('create', 'job', xml='<project/>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Which failed requests to Jenkins are made again
+
+import socket
+import threading
+import unittest
+
+from jenkins_jobs.transport import (ConnectionPool, HTTPError,
+                                    UncertainRequestError, is_transient)
+
+
+class SilentServer(object):
+    """Accept connections and read requests, but never answer."""
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.url = 'http://127.0.0.1:{0}/'.format(
+            self.socket.getsockname()[1])
+        self.received = 0
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except socket.error:
+                return
+            if connection.recv(65536):
+                self.received += 1
+
+    def close(self):
+        self.socket.close()
+
+
+class TransientTestCase(unittest.TestCase):
+
+    def test_statuses(self):
+        self.assertTrue(is_transient(HTTPError(500, 'GET', 'url')))
+        self.assertTrue(is_transient(HTTPError(503, 'POST', 'url')))
+        self.assertTrue(is_transient(HTTPError(429, 'POST', 'url')))
+        self.assertFalse(is_transient(HTTPError(500, 'POST', 'url')))
+        self.assertFalse(is_transient(HTTPError(504, 'POST', 'url')))
+        self.assertFalse(is_transient(HTTPError(404, 'GET', 'url')))
+
+    def test_unanswered_post(self):
+        server = SilentServer()
+        try:
+            pool = ConnectionPool(server.url, timeout=0.2)
+            self.assertRaises(socket.timeout, pool.request, 'GET',
+                              server.url + 'api/json')
+            try:
+                pool.request('POST', server.url + 'createItem?name=job',
+                             '<project/>')
+            except UncertainRequestError, e:
+                self.assertFalse(is_transient(e))
+            else:
+                self.fail('The POST did not fail')
+            self.assertEqual(server.received, 2)
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
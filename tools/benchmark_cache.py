@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Measure the cost of updating every entry of a large job cache, the way
+# "jenkins-jobs update" does, against rewriting the whole cache file on
+# every change as earlier versions did.  The cache is created in a
+# temporary directory, the user's own cache is not touched.
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from jenkins_jobs.builder import CacheStorage, YamlDumper
+
+
+def job_hashes(entries, salt):
+    for i in xrange(entries):
+        name = 'project-{0}-unit-tests-{1}'.format(i // 10, i % 10)
+        yield name, hashlib.md5(salt + name).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=50000,
+                        help='number of jobs in the cache '
+                        '(default: %(default)s)')
+    parser.add_argument('--sample', type=int, default=100,
+                        help='number of whole-file rewrites to time for '
+                        'the old behaviour (default: %(default)s)')
+    options = parser.parse_args()
+
+    cache_home = tempfile.mkdtemp()
+    os.environ['XDG_CACHE_HOME'] = cache_home
+    try:
+        cache = CacheStorage()
+        cache.data = dict(job_hashes(options.entries, 'old'))
+        cache.dirty = True
+        cache.save()
+        size = os.path.getsize(cache.cachefilename)
+        print 'Cache of {0} entries, {1} bytes'.format(options.entries, size)
+
+        start = time.time()
+        cache = CacheStorage()
+        load_time = time.time() - start
+        print 'Load: {0:.2f}s'.format(load_time)
+
+        start = time.time()
+        for name, md5 in job_hashes(options.entries, 'new'):
+            cache.set(name, md5)
+        cache.save()
+        batched_time = time.time() - start
+        print 'Update all entries, batched: {0:.2f}s'.format(batched_time)
+
+        # Rewriting the file on every set() costs the same each time, so
+        # a sample is timed and extrapolated.
+        start = time.time()
+        for name, md5 in job_hashes(options.sample, 'old'):
+            cache.data[name] = md5
+            with open(cache.cachefilename, 'w') as yfile:
+                yaml.dump(cache.data, yfile, Dumper=YamlDumper)
+        per_set = (time.time() - start) / options.sample
+        print ('Update all entries, rewriting on every change: {0:.0f}s '
+               '(estimated from {1} rewrites, {2:.3f}s each, {3} '
+               'bytes written)'.format(per_set * options.entries,
+                                       options.sample, per_set,
+                                       size * options.entries))
+    finally:
+        shutil.rmtree(cache_home)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# Measure the request rate to a local stand-in for a Jenkins server,
+# fetching job configurations through the jenkins-jobs client with and
+# without reusing connections.
+
+import argparse
+import time
+
+from jenkins_jobs.fakejenkins import FakeJenkins, empty_config
+from jenkins_jobs.parallel import run_in_parallel
+from jenkins_jobs.transport import PooledJenkins
+
+
+def measure(url, pool_size, requests, jobs, workers):
+    client = PooledJenkins(url, pool_size=pool_size)
+    start = time.time()
+    names = ('job-{0}'.format(i % jobs) for i in xrange(requests))
+    for name, result, error in run_in_parallel(client.get_job_config,
+                                               names, workers):
+        if error:
+            raise error
+    elapsed = time.time() - start
+    client.pool.close()
+    return requests / elapsed, client.pool.created
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests to make (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=100,
+                        help='jobs on the server (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='concurrent requests (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server takes to answer each '
+                        'request (default: %(default)s)')
+    options = parser.parse_args()
+
+    jobs = dict(('job-{0}'.format(i), empty_config())
+                for i in xrange(options.jobs))
+    with FakeJenkins(jobs, options.latency) as jenkins:
+        for label, pool_size in (('without pooling', 0),
+                                 ('with pooling', options.workers)):
+            rate, connections = measure(jenkins.url, pool_size,
+                                        options.requests, options.jobs,
+                                        options.workers)
+            print '{0}: {1:.0f} requests/s, {2} connections'.format(
+                label, rate, connections)
+        print 'Requests served: {0}'.format(sum(jenkins.requests.values()))
+
+
+if __name__ == '__main__':
+    main()